@@ -85,9 +85,12 @@ def wait_for_info(section, server):
 			server.disconnect()
 			return
 
-	server.connect()
+	# don't let a server that never finishes logging us in hold things up
+	server.call_later(30, server.disconnect)
+	server.connect(timeout=10)
 	server.login(nickname, username, password, client_name, callback=cb)
-	server.handle_messages(timeout=0.5, callback=cb)
+	if not server.disconnecting:
+		server.disconnect()
 
 
 def summarize_server(section, server):
@@ -120,9 +123,9 @@ def main():
 	tasks = {}
 	for section in config.sections():
 		host = get(section, "host")
-		tcpport = get(section, "tcpport")
-		udpport = get(section, "udpport")
-		encrypted = bool(get(section, "encrypted", False))
+		tcpport = int(get(section, "tcpport", 10333))
+		udpport = int(get(section, "udpport", 0))
+		encrypted = config.getboolean(section, "encrypted", fallback=False)
 		server = teamtalk.TeamTalkServer(host, tcpport, udpport, use_ssl=encrypted)
 		tasks[executor.submit(wait_for_info, section, server)] = (section, server)
 	print(str(len(tasks)) + " servers loaded")
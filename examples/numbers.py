@@ -2,9 +2,8 @@
 numbers.py
 
 TeamTalk bot that retrieves facts from the Numbers API.
-It lacks some more advanced features that one would expect from this sort of
-thing e.g. rate limiting and threading, but should serve as a basic example
-upon which something better could be built."""
+Commands are handled by teamtalk.commands.CommandRouter, which runs them on
+worker threads and limits each user to one at a time."""
 
 # A part of PyTeamTalk
 # author: Carter Temm
@@ -13,21 +12,32 @@ upon which something better could be built."""
 
 import requests
 import teamtalk
+from teamtalk.commands import CommandRouter
+from teamtalk.cache import ResultCache
 
 
 # Extremely thin wrapper here
 endpoint_url = "http://numbersapi.com/"
+# facts about a particular number don't change, so everyone asking for the same one shares a single request
+cache = ResultCache(maxsize=1000, ttl=3600, stale_ttl=86400)
+
+
+@cache.cached
+def fetch(path):
+	r = requests.get(path, timeout=10)
+	r.raise_for_status()
+	return r.text
 
 
 def make_request(*args):
 	path = endpoint_url + "/".join(args)
 	try:
-		r = requests.get(path)
-		r.raise_for_status()
+		if "random" in args:
+			# a different fact every time
+			return fetch.__wrapped__(path)
+		return fetch(path)
 	except Exception as exc:
 		return str(exc)
-	else:
-		return r.text
 
 
 def trivia(number=None):
@@ -67,25 +77,31 @@ def help():
 
 
 t = teamtalk.TeamTalkServer()
+# facts are fetched on worker threads, so one slow request doesn't hold up everybody else
+router = CommandRouter(unknown=lambda ctx: help())
+
+
+@router.command("trivia")
+def trivia_command(ctx):
+	return trivia(*ctx.args[:1])
+
+
+@router.command("math")
+def math_command(ctx):
+	return math(*ctx.args[:1])
+
+
+@router.command("date")
+def date_command(ctx):
+	return date(*ctx.args[:1])
+
+
+@router.command("year")
+def year_command(ctx):
+	return year(*ctx.args[:1])
 
 
-@t.subscribe("messagedeliver")
-def message(server, params):
-	if params["type"] == teamtalk.USER_MSG:
-		content = params["content"].strip().lower().split(" ")
-		source = t.get_user(params["srcuserid"])
-		if content[0] == "trivia":
-			func = trivia
-		elif content[0] == "math":
-			func = math
-		elif content[0] == "date":
-			func = date
-		elif content[0] == "year":
-			func = year
-		else:
-			server.user_message(source, help())
-			return
-		server.user_message(source, func(*content[1:]))
+router.attach(t)
 
 
 if __name__ == "__main__":
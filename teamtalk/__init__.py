@@ -1 +1,7 @@
 from teamtalk.teamtalk import *
+from teamtalk.query import *
+from teamtalk.snapshot import *
+from teamtalk.presence import *
+from teamtalk.dispatch import *
+from teamtalk.timers import *
+from teamtalk.history import *
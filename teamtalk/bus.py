@@ -0,0 +1,340 @@
+"""Shares one server connection with any number of local processes.
+
+Services that each log in to the same server multiply its load, and every one of them parses the same traffic.
+EventPublisher lets a single TeamTalkServer hand its parsed events to local subscribers over a Unix socket instead. Each event is encoded once and the same bytes are written to every subscriber. Subscribers that connect late are sent a snapshot of the server's state first, so they don't need to have been around for login.
+
+Frames are a 4 byte big-endian length followed by a marshalled (event, params) tuple, so publisher and subscribers must run the same version of Python."""
+
+# A part of PyTeamTalk
+# author: Carter Temm
+# License: MIT
+
+import marshal
+import os
+import selectors
+import socket
+import struct
+import threading
+
+from teamtalk.dispatch import STATE_EVENTS
+
+
+_header = struct.Struct("!I")
+
+
+def encode_frame(event, params):
+	"""Returns the bytes of a single frame"""
+	payload = marshal.dumps((event, params))
+	return _header.pack(len(payload)) + payload
+
+
+def _snapshot_params(snapshot):
+	return {
+		"version": snapshot.version,
+		"server_params": dict(snapshot.server_params),
+		"me": dict(snapshot.me),
+		"channels": [dict(channel) for channel in snapshot.channels.values()],
+		"users": [dict(user) for user in snapshot.users.values()],
+	}
+
+
+class _Subscriber:
+	__slots__ = ("sock", "outbox", "pending", "offset")
+
+	def __init__(self, sock):
+		self.sock = sock
+		# frames waiting to be written, shared between subscribers
+		self.outbox = []
+		self.pending = 0
+		self.offset = 0
+
+
+class EventPublisher:
+	"""Publishes every event received by server to subscribers connected to the Unix socket at path
+	The socket is created by start and removed by stop. Any existing file at path is replaced
+	A subscriber that falls more than max_backlog bytes behind is disconnected rather than letting its backlog grow without limit
+	metrics holds counters: published (events), subscribers (connected right now), accepted and dropped (subscribers disconnected for falling behind)"""
+
+	def __init__(self, server, path, max_backlog=4 * 1024 * 1024):
+		self.server = server
+		self.path = path
+		self.max_backlog = max_backlog
+		self.metrics = {"published": 0, "subscribers": 0, "accepted": 0, "dropped": 0}
+		self.lock = threading.Lock()
+		self._subscribers = {}
+		self._listener = None
+		self._selector = None
+		self._waker = None
+		self._thread = None
+		self._running = False
+
+	def start(self):
+		"""Starts accepting subscribers and publishing events. Returns immediately"""
+		if os.path.exists(self.path):
+			os.unlink(self.path)
+		self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self._listener.bind(self.path)
+		self._listener.listen(16)
+		self._listener.setblocking(False)
+		self._waker = socket.socketpair()
+		for i in self._waker:
+			i.setblocking(False)
+		self._selector = selectors.DefaultSelector()
+		self._selector.register(self._listener, selectors.EVENT_READ, "accept")
+		self._selector.register(self._waker[0], selectors.EVENT_READ, "wakeup")
+		self._running = True
+		self.server.subscribe("*", self.publish)
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+
+	def stop(self):
+		"""Disconnects every subscriber and stops publishing"""
+		if not self._running:
+			return
+		self._running = False
+		self.server.unsubscribe("*", self.publish)
+		self._wakeup()
+		self._thread.join()
+
+	def publish(self, server, event, params):
+		"""Queues an event for every subscriber. Subscribed to "*" on the server by start, so it runs on the thread handling messages and never blocks on subscribers"""
+		frame = encode_frame(event, params)
+		with self.lock:
+			self.metrics["published"] += 1
+			if not self._subscribers:
+				return
+			for subscriber in self._subscribers.values():
+				subscriber.outbox.append(frame)
+				subscriber.pending += len(frame)
+		self._wakeup()
+
+	def _wakeup(self):
+		try:
+			self._waker[1].send(b"\0")
+		except (BlockingIOError, OSError):
+			# already pending
+			pass
+
+	def _run(self):
+		try:
+			while self._running:
+				for key, mask in self._selector.select():
+					if key.data == "accept":
+						self._accept()
+					elif key.data == "wakeup":
+						try:
+							while self._waker[0].recv(4096):
+								pass
+						except BlockingIOError:
+							pass
+					elif mask & selectors.EVENT_READ:
+						# subscribers have nothing to say, so this means they've gone away
+						self._read(key.fileobj)
+				self._flush()
+		finally:
+			with self.lock:
+				subscribers = list(self._subscribers.values())
+				self._subscribers.clear()
+				self.metrics["subscribers"] = 0
+			for subscriber in subscribers:
+				subscriber.sock.close()
+			self._selector.close()
+			self._listener.close()
+			for i in self._waker:
+				i.close()
+			try:
+				os.unlink(self.path)
+			except OSError:
+				pass
+
+	def _accept(self):
+		try:
+			sock, address = self._listener.accept()
+		except BlockingIOError:
+			return
+		sock.setblocking(False)
+		subscriber = _Subscriber(sock)
+		# taken under the lock so no event can slip in between the snapshot and the first one queued
+		with self.lock:
+			frame = encode_frame("snapshot", _snapshot_params(self.server.snapshot()))
+			subscriber.outbox.append(frame)
+			subscriber.pending = len(frame)
+			self._subscribers[sock.fileno()] = subscriber
+			self.metrics["subscribers"] += 1
+			self.metrics["accepted"] += 1
+		self._selector.register(sock, selectors.EVENT_READ, subscriber)
+
+	def _read(self, sock):
+		try:
+			data = sock.recv(4096)
+		except BlockingIOError:
+			return
+		except OSError:
+			data = b""
+		if not data:
+			self._remove(sock.fileno())
+
+	def _flush(self):
+		with self.lock:
+			subscribers = list(self._subscribers.items())
+		for fileno, subscriber in subscribers:
+			with self.lock:
+				if subscriber.pending > self.max_backlog:
+					self.metrics["dropped"] += 1
+					drop = True
+				else:
+					drop = False
+					frames = subscriber.outbox[:]
+			if drop:
+				self._remove(fileno)
+				continue
+			result = self._write(subscriber, frames)
+			if result is None:
+				self._remove(fileno)
+				continue
+			written, sent = result
+			with self.lock:
+				del subscriber.outbox[:written]
+				subscriber.pending -= sent
+			events = selectors.EVENT_READ | (selectors.EVENT_WRITE if subscriber.outbox else 0)
+			self._selector.modify(subscriber.sock, events, subscriber)
+
+	def _write(self, subscriber, frames):
+		"""Writes as many frames as the socket will take
+		Returns how many frames were written completely and the number of bytes sent, or None if the subscriber has gone away"""
+		written = 0
+		total = 0
+		for frame in frames:
+			try:
+				sent = subscriber.sock.send(memoryview(frame)[subscriber.offset:])
+			except BlockingIOError:
+				break
+			except OSError:
+				return None
+			total += sent
+			subscriber.offset += sent
+			if subscriber.offset < len(frame):
+				break
+			subscriber.offset = 0
+			written += 1
+		return written, total
+
+	def _remove(self, fileno):
+		with self.lock:
+			subscriber = self._subscribers.pop(fileno, None)
+			if subscriber is None:
+				return
+			self.metrics["subscribers"] -= 1
+		self._selector.unregister(subscriber.sock)
+		subscriber.sock.close()
+
+
+class EventSubscriber:
+	"""Receives the events of a server shared by an EventPublisher, keeping its own copy of the server's state
+	server_params, me, channels and users (the last two being dicts keyed by id) are filled in from the snapshot sent on connecting and kept up to date from then on
+	Use subscribe as with TeamTalkServer, then call handle_messages"""
+
+	def __init__(self, path):
+		self.path = path
+		self.sock = None
+		self.connected = False
+		self.subscriptions = {}
+		self.version = None
+		self.server_params = {}
+		self.me = {}
+		self.channels = {}
+		self.users = {}
+		self._buffer = bytearray()
+
+	def connect(self, timeout=None):
+		"""Connects to the publisher and waits for the state snapshot
+		Raises OSError on failure"""
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.sock.settimeout(timeout)
+		self.sock.connect(self.path)
+		self.connected = True
+		event, params = self.read_event()
+		if event != "snapshot":
+			raise ConnectionError("Expected a snapshot, got " + repr(event))
+		# timeout only applies to connecting, handle_messages waits for events indefinitely
+		self.sock.settimeout(None)
+
+	def close(self):
+		self.connected = False
+		if self.sock:
+			self.sock.close()
+
+	def subscribe(self, event, func=None):
+		"""Calls func(subscriber, params) every time event arrives, after the local state has been updated
+		As with TeamTalkServer, "*" receives every event as func(subscriber, event, params). Can be used as a decorator"""
+		def wrapper(_func):
+			self.subscriptions.setdefault(event.lower(), []).append(_func)
+			return _func
+		if func:
+			return wrapper(func)
+		return wrapper
+
+	def unsubscribe(self, event, func):
+		self.subscriptions[event.lower()].remove(func)
+
+	def read_event(self):
+		"""Reads, applies and returns the next (event, params)
+		Raises EOFError once the publisher goes away"""
+		while True:
+			if len(self._buffer) >= _header.size:
+				length = _header.unpack_from(self._buffer)[0]
+				end = _header.size + length
+				if len(self._buffer) >= end:
+					event, params = marshal.loads(memoryview(self._buffer)[_header.size:end])
+					del self._buffer[:end]
+					self._apply(event, params)
+					return event, params
+			data = self.sock.recv(65536)
+			if not data:
+				self.connected = False
+				raise EOFError("Publisher closed the connection")
+			self._buffer += data
+
+	def handle_messages(self):
+		"""Dispatches events to subscribed functions until the publisher goes away or close is called"""
+		while self.connected:
+			try:
+				event, params = self.read_event()
+			except (EOFError, OSError):
+				break
+			for func in self.subscriptions.get(event, []):
+				func(self, params)
+			for func in self.subscriptions.get("*", []):
+				func(self, event, params)
+
+	def get_users_in_channel(self, chanid=None):
+		return [user for user in self.users.values() if user.get("chanid") == chanid]
+
+	def _apply(self, event, params):
+		# events published just after a subscriber connects may already be reflected in its snapshot, so applying them again must be harmless
+		if event == "snapshot":
+			self.version = params["version"]
+			self.server_params = params["server_params"]
+			self.me = params["me"]
+			self.channels = {channel["chanid"]: channel for channel in params["channels"]}
+			self.users = {user["userid"]: user for user in params["users"]}
+		elif event not in STATE_EVENTS:
+			return
+		elif event == "accepted":
+			self.me.update(params)
+		elif event == "serverupdate":
+			self.server_params.update(params)
+		elif event in ("addchannel", "updatechannel"):
+			self.channels.setdefault(params["chanid"], {}).update(params)
+		elif event == "removechannel":
+			self.channels.pop(params["chanid"], None)
+		elif event == "loggedin":
+			self.users.setdefault(params["userid"], {}).update(params)
+		elif event == "loggedout":
+			self.users.pop(params.get("userid"), None)
+		else:
+			user = self.users.get(params["userid"])
+			if user is not None:
+				user.update(params)
+				if event == "removeuser":
+					user.pop("chanid", None)
@@ -0,0 +1,187 @@
+"""Caches for data that is expensive to fetch from a server."""
+
+# A part of PyTeamTalk
+# author: Carter Temm
+# License: MIT
+
+import collections
+import functools
+import threading
+import time
+
+from teamtalk.query import Index, Where, And
+
+
+class RecordCache:
+	"""A list of records (accounts, bans, etc) that is downloaded once, then patched as changes are seen rather than downloaded again.
+	records is the list to keep up to date, and is shared with the owner (TeamTalkServer.accounts, for instance)
+	keys are the fields that records can be looked up by in O(1)
+	The cache is considered stale ttl seconds after it was filled, or after a call to invalidate. If ttl is None, it never expires on its own"""
+
+	def __init__(self, records, keys, ttl=300):
+		self.records = records
+		self.ttl = ttl
+		self.filled_at = None
+		# keyed by id(record), records stay alive in self.records for as long as they're indexed
+		self._index = Index(keys)
+
+	@property
+	def fresh(self):
+		"""True if the cache has been filled and hasn't expired or been invalidated since"""
+		if self.filled_at is None:
+			return False
+		return self.ttl is None or time.monotonic() - self.filled_at < self.ttl
+
+	def clear(self):
+		"""Empties the cache, usually in preparation for filling it again"""
+		self.records.clear()
+		self._index.clear()
+
+	def filled(self):
+		"""Marks the cache as complete, starting the ttl"""
+		self.filled_at = time.monotonic()
+
+	def invalidate(self):
+		"""Forces the next request to download everything again"""
+		self.filled_at = None
+
+	def add(self, record):
+		"""Adds a record to the cache"""
+		self.records.append(record)
+		self._index.add(id(record), record)
+
+	def discard(self, condition=None, **fields):
+		"""Removes every record matching all of the given fields, e.g. discard(username="bob")
+		condition, if given, is called with each of those records and only the ones it returns True for are removed
+		Returns the number of records removed"""
+		removed = self.lookup(**fields)
+		if condition is not None:
+			removed = [record for record in removed if condition(record)]
+		for record in removed:
+			self._index.remove(id(record))
+			self.records.remove(record)
+		return len(removed)
+
+	def lookup(self, **fields):
+		"""Returns a list of records matching all of the given fields"""
+		predicates = [Where(field, value) for field, value in fields.items()]
+		if len(predicates) == 1:
+			return self._index.find(predicates[0])
+		return self._index.find(And(*predicates))
+
+
+class _Flight:
+	"""A call in progress, which other callers wanting the same result wait on"""
+
+	__slots__ = ("event", "value", "error")
+
+	def __init__(self):
+		self.event = threading.Event()
+		self.value = None
+		self.error = None
+
+
+class ResultCache:
+	"""Remembers the results of slow calls, such as a bot fetching something from a web API
+	Holds up to maxsize results, evicting the least recently used. Results are fresh for ttl seconds, then served stale for up to stale_ttl seconds more while being refreshed in the background
+	Concurrent calls for a result that isn't cached yet are coalesced, so only one of them actually runs and the rest wait for it. Exceptions are passed on to everyone waiting but not cached
+	metrics counts hits, stale (stale results served), misses, coalesced (calls that waited on another), refreshes, errors and evictions. Safe to use from any thread"""
+
+	def __init__(self, maxsize=256, ttl=60, stale_ttl=0):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.stale_ttl = stale_ttl
+		self.lock = threading.Lock()
+		self.metrics = {"hits": 0, "stale": 0, "misses": 0, "coalesced": 0, "refreshes": 0, "errors": 0, "evictions": 0}
+		# key -> (value, fresh until, usable until)
+		self._entries = collections.OrderedDict()
+		self._flights = {}
+
+	def __len__(self):
+		return len(self._entries)
+
+	def get(self, key, func, *args, **kwargs):
+		"""Returns the cached result for key, calling func(*args, **kwargs) to get it if need be"""
+		now = time.monotonic()
+		refresh = False
+		with self.lock:
+			entry = self._entries.get(key)
+			if entry is not None and now < entry[2]:
+				self._entries.move_to_end(key)
+				if now < entry[1]:
+					self.metrics["hits"] += 1
+					return entry[0]
+				self.metrics["stale"] += 1
+				if key not in self._flights:
+					flight = self._flights[key] = _Flight()
+					self.metrics["refreshes"] += 1
+					refresh = True
+				value = entry[0]
+				leader = None
+			else:
+				flight = self._flights.get(key)
+				leader = flight is None
+				if leader:
+					self.metrics["misses"] += 1
+					flight = self._flights[key] = _Flight()
+				else:
+					self.metrics["coalesced"] += 1
+		if leader is None:
+			if refresh:
+				threading.Thread(target=self._fill, args=(key, flight, func, args, kwargs), daemon=True).start()
+			return value
+		if leader:
+			self._fill(key, flight, func, args, kwargs)
+		else:
+			flight.event.wait()
+		if flight.error is not None:
+			raise flight.error
+		return flight.value
+
+	def cached(self, func=None, key=None):
+		"""Decorator caching a function's results by its arguments, which must be hashable
+		key, if given, is called with the same arguments and returns the key to use instead
+		The original function is available as __wrapped__, for calls that shouldn't be cached"""
+		def wrapper(_func):
+			@functools.wraps(_func)
+			def call(*args, **kwargs):
+				if key is not None:
+					k = key(*args, **kwargs)
+				else:
+					k = (_func.__qualname__, args, tuple(sorted(kwargs.items())))
+				return self.get(k, _func, *args, **kwargs)
+			return call
+		if func:
+			return wrapper(func)
+		return wrapper
+
+	def invalidate(self, key=None):
+		"""Forgets the result for key, or every result if None"""
+		with self.lock:
+			if key is None:
+				self._entries.clear()
+			else:
+				self._entries.pop(key, None)
+
+	def _fill(self, key, flight, func, args, kwargs):
+		try:
+			flight.value = func(*args, **kwargs)
+		except Exception as exc:
+			flight.error = exc
+		except BaseException:
+			# KeyboardInterrupt and the like carry on up the stack, while anyone waiting on us gets an error of their own
+			flight.error = RuntimeError(f"Loading {key!r} was interrupted")
+			raise
+		finally:
+			now = time.monotonic()
+			with self.lock:
+				if flight.error is None:
+					self._entries[key] = (flight.value, now + self.ttl, now + self.ttl + self.stale_ttl)
+					self._entries.move_to_end(key)
+					while len(self._entries) > self.maxsize:
+						self._entries.popitem(last=False)
+						self.metrics["evictions"] += 1
+				else:
+					self.metrics["errors"] += 1
+				del self._flights[key]
+			flight.event.set()
@@ -0,0 +1,218 @@
+"""Routing of text commands sent to bots.
+
+Rather than an if/elif chain in a messagedeliver handler, commands are registered with a CommandRouter, which finds the right one (accepting unambiguous abbreviations and aliases), splits its arguments and runs it on a pool of worker threads. Slow commands then can't hold up the connection, and one user can't tie up the whole bot."""
+
+# A part of PyTeamTalk
+# author: Carter Temm
+# License: MIT
+
+import concurrent.futures
+import shlex
+import threading
+import traceback
+
+from teamtalk.teamtalk import USER_MSG, CHANNEL_MSG, message_subscriptions
+
+
+class Command:
+	"""A registered command. func is called with a CommandContext"""
+
+	__slots__ = ("name", "func", "aliases", "help")
+
+	def __init__(self, name, func, aliases=(), help=None):
+		self.name = name
+		self.func = func
+		self.aliases = tuple(aliases)
+		self.help = help if help is not None else (func.__doc__ or "").strip()
+
+	def __repr__(self):
+		return f"<Command {self.name}>"
+
+
+class CommandContext:
+	"""Everything a command needs to know about how it was invoked
+		server, params: as passed to the messagedeliver handler
+		user: the sender's attributes, or an empty dict if unknown
+		command: the Command being run
+		name: the command as it was typed, which may be an alias or abbreviation
+		args: the arguments, split like a shell would so "quoted phrases" stay together
+		text: everything after the command name, unsplit"""
+
+	__slots__ = ("server", "params", "user", "command", "name", "args", "text")
+
+	def __init__(self, server, params, user, command, name, args, text):
+		self.server = server
+		self.params = params
+		self.user = user
+		self.command = command
+		self.name = name
+		self.args = args
+		self.text = text
+
+	def reply(self, content):
+		"""Answers the way the command was sent: privately, or to the channel it was sent to"""
+		if self.params["type"] == CHANNEL_MSG:
+			self.server.channel_message(content, to=self.params["chanid"])
+		else:
+			self.server.user_message(self.params["srcuserid"], content)
+
+
+class _Node:
+	__slots__ = ("children", "command", "below")
+
+	def __init__(self):
+		self.children = {}
+		# the command whose name or alias ends here, if any
+		self.command = None
+		# every command reachable from here, to tell whether an abbreviation is ambiguous
+		self.below = set()
+
+
+class CommandRouter:
+	"""Dispatches messages to registered commands, see command and attach
+	prefix is required at the start of every command, e.g. "!" (none by default)
+	types lists the kinds of message commands are accepted from (teamtalk.USER_MSG, CHANNEL_MSG)
+	abbreviations allows any unambiguous start of a name, so "tri" runs "trivia"
+	workers is how many commands may run at once overall, per_user how many for any one user (counted by username if they have one, otherwise by userid), and max_pending how many may be running or waiting in total
+	Commands that would go over a limit are turned away with busy_message, if set
+	unknown, if given, is called with a CommandContext (whose command is None) for messages that don't match anything
+	A command returning a string replies with it"""
+
+	def __init__(
+		self,
+		prefix="",
+		types=(USER_MSG,),
+		abbreviations=True,
+		workers=8,
+		per_user=1,
+		max_pending=100,
+		busy_message="Busy, try again in a moment",
+		unknown=None,
+	):
+		self.prefix = prefix
+		self.types = set(types)
+		self.abbreviations = abbreviations
+		self.per_user = per_user
+		self.max_pending = max_pending
+		self.busy_message = busy_message
+		self.unknown = unknown
+		self.commands = {}
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="command")
+		self.lock = threading.Lock()
+		self._root = _Node()
+		self._pending = 0
+		self._running = {}
+		self._servers = []
+
+	def command(self, name=None, aliases=(), help=None):
+		"""Registers a function as a command, named after the function unless name is given. Use as a decorator"""
+		def wrapper(func):
+			self.add(Command((name or func.__name__).lower(), func, [i.lower() for i in aliases], help))
+			return func
+		return wrapper
+
+	def add(self, command):
+		"""Registers a Command. Its name and aliases must not already be taken"""
+		for word in (command.name,) + command.aliases:
+			if self._find_node(word) and self._find_node(word).command:
+				raise ValueError(f"{word} is already registered")
+		self.commands[command.name] = command
+		for word in (command.name,) + command.aliases:
+			node = self._root
+			node.below.add(command)
+			for char in word:
+				node = node.children.setdefault(char, _Node())
+				node.below.add(command)
+			node.command = command
+
+	def resolve(self, word):
+		"""Returns the Command called word, by name, alias or unambiguous abbreviation, or None"""
+		node = self._find_node(word.lower())
+		if node is None:
+			return None
+		if node.command:
+			return node.command
+		if self.abbreviations and len(node.below) == 1:
+			return next(iter(node.below))
+		return None
+
+	@property
+	def sublocal(self):
+		"""The subscriptions handle_message needs, for TeamTalkServer.prune_subscriptions"""
+		return message_subscriptions(self.types)
+
+	def attach(self, server):
+		"""Starts handling commands sent to server"""
+		server.subscribe("messagedeliver", self.handle_message)
+		self._servers.append(server)
+
+	def detach(self, server):
+		server.unsubscribe("messagedeliver", self.handle_message)
+		self._servers.remove(server)
+
+	def close(self, wait=True):
+		"""Stops running commands, waiting for those already started if wait is True"""
+		for server in list(self._servers):
+			self.detach(server)
+		self.executor.shutdown(wait=wait)
+
+	def handle_message(self, server, params):
+		"""Subscribed to messagedeliver by attach. Returns quickly, as the command itself runs on a worker"""
+		if params.get("type") not in self.types or params.get("srcuserid") == server.me.get("userid"):
+			return
+		content = params.get("content", "").strip()
+		if not content.startswith(self.prefix):
+			return
+		name, _, text = content[len(self.prefix):].partition(" ")
+		command = self.resolve(name) if name else None
+		if command is None and self.unknown is None:
+			return
+		text = text.strip()
+		try:
+			args = shlex.split(text)
+		except ValueError:
+			# unbalanced quotes
+			args = text.split()
+		user = server.user_indexes.records.get(params.get("srcuserid")) or {}
+		context = CommandContext(server, params, user, command, name, args, text)
+		key = (id(server), user.get("username") or params.get("srcuserid"))
+		with self.lock:
+			busy = self._pending >= self.max_pending or self._running.get(key, 0) >= self.per_user
+			if not busy:
+				self._pending += 1
+				self._running[key] = self._running.get(key, 0) + 1
+		if busy:
+			if self.busy_message:
+				context.reply(self.busy_message)
+			return
+		try:
+			self.executor.submit(self._run, context, key)
+		except RuntimeError:
+			# closed while the message was on its way
+			self._release(key)
+
+	def _run(self, context, key):
+		try:
+			func = context.command.func if context.command else self.unknown
+			result = func(context)
+			if isinstance(result, str) and result:
+				context.reply(result)
+		except Exception:
+			traceback.print_exc()
+		finally:
+			self._release(key)
+
+	def _release(self, key):
+		with self.lock:
+			self._pending -= 1
+			self._running[key] -= 1
+			if not self._running[key]:
+				del self._running[key]
+
+	def _find_node(self, word):
+		node = self._root
+		for char in word:
+			node = node.children.get(char)
+			if node is None:
+				return None
+		return node
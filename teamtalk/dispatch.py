@@ -0,0 +1,150 @@
+"""Bounded hand-off of events between the thread reading from a server and the one running handlers.
+
+See TeamTalkServer.start_dispatcher."""
+
+# A part of PyTeamTalk
+# author: Carter Temm
+# License: MIT
+
+import collections
+import contextlib
+import threading
+
+
+# events that change the state of a server
+STATE_EVENTS = (
+	"accepted",
+	"serverupdate",
+	"addchannel",
+	"updatechannel",
+	"removechannel",
+	"loggedin",
+	"loggedout",
+	"adduser",
+	"removeuser",
+	"updateuser",
+)
+
+# events the drop policy never discards, as handlers tracking state of their own would go wrong without them
+PROTECTED_EVENTS = frozenset(STATE_EVENTS + ("begin", "end", "joined", "left", "addfile", "removefile", "useraccount", "userbanned"))
+
+# events that only carry the latest attributes of something, and the parameter identifying it
+COALESCED_EVENTS = {"updateuser": "userid", "updatechannel": "chanid", "serverupdate": None}
+
+# events put never waits for room for. They make up replies (see TeamTalkServer.get_bans) a handler may be waiting for, while the reader would be waiting for it
+UNBLOCKED_EVENTS = frozenset(("begin", "end", "useraccount", "userbanned"))
+
+POLICIES = ("block", "drop", "coalesce")
+
+
+class EventQueue:
+	"""A queue of (event, params) holding at most maxsize events. What happens when it's full depends on policy:
+		block: put waits until there's room, so nothing is lost but reading from the server stalls for as long as handlers do
+		drop: the oldest event not in PROTECTED_EVENTS (for instance a message) is discarded to make room. If there's none, put waits
+		coalesce: an update to a user, channel or the server that's still waiting is merged with the new one instead of queueing both, whether full or not. When full, put waits
+	Events in UNBLOCKED_EVENTS are queued regardless, as is everything while unbounded is in effect
+	Depth and counts of dropped and coalesced events are kept in metrics, which may be shared (e.g. TeamTalkServer.metrics)"""
+
+	def __init__(self, maxsize=1000, policy="block", metrics=None):
+		if policy not in POLICIES:
+			raise ValueError(f"policy must be one of {', '.join(POLICIES)}")
+		if maxsize < 1:
+			raise ValueError("maxsize must be at least 1")
+		self.maxsize = maxsize
+		self.policy = policy
+		self.metrics = metrics if metrics is not None else {}
+		self.metrics.update({"queue_depth": 0, "queue_peak": 0, "queue_dropped": 0, "queue_coalesced": 0, "queue_blocked": 0})
+		self.closed = False
+		# entries are lists of [event, params] so coalescing can change them in place. Dropped entries stay behind with event set to None, for get to skip
+		self._queue = collections.deque()
+		self._size = 0
+		# entries the drop policy may discard, oldest first
+		self._droppable = collections.deque()
+		# (event, identifier) -> entry waiting in the queue
+		self._pending = {}
+		self._unbounded = 0
+		self._condition = threading.Condition()
+
+	def __len__(self):
+		return self._size
+
+	@contextlib.contextmanager
+	def unbounded(self):
+		"""While in effect, put queues events rather than wait for room
+		For when the thread getting events waits on the one putting them, which would otherwise wait on it in turn"""
+		with self._condition:
+			self._unbounded += 1
+			self._condition.notify_all()
+		try:
+			yield
+		finally:
+			with self._condition:
+				self._unbounded -= 1
+
+	def put(self, event, params):
+		"""Queues an event, following the policy if full. Returns False if the queue has been closed"""
+		with self._condition:
+			if self.policy == "coalesce" and event in COALESCED_EVENTS:
+				key = (event, params.get(COALESCED_EVENTS[event]))
+				entry = self._pending.get(key)
+				if entry is not None:
+					entry[1].update(params)
+					self.metrics["queue_coalesced"] += 1
+					return True
+			if self._size >= self.maxsize and event not in UNBLOCKED_EVENTS and not self._unbounded and not (self.policy == "drop" and self._drop_oldest()):
+				self.metrics["queue_blocked"] += 1
+				while self._size >= self.maxsize and not self.closed and not self._unbounded:
+					self._condition.wait()
+			if self.closed:
+				return False
+			if self.policy == "coalesce" and event in COALESCED_EVENTS:
+				# copied, as it may be merged with later updates
+				entry = [event, dict(params)]
+				self._pending[key] = entry
+			else:
+				entry = [event, params]
+				if self.policy == "drop" and event not in PROTECTED_EVENTS:
+					self._droppable.append(entry)
+			self._queue.append(entry)
+			self._size += 1
+			depth = self._size
+			self.metrics["queue_depth"] = depth
+			if depth > self.metrics["queue_peak"]:
+				self.metrics["queue_peak"] = depth
+			self._condition.notify_all()
+			return True
+
+	def get(self):
+		"""Waits for and returns the next (event, params), or None once the queue has been closed and emptied"""
+		with self._condition:
+			while not self._size:
+				if self.closed:
+					return None
+				self._condition.wait()
+			event, params = self._queue.popleft()
+			while event is None:
+				event, params = self._queue.popleft()
+			self._size -= 1
+			if self.policy == "coalesce" and event in COALESCED_EVENTS:
+				self._pending.pop((event, params.get(COALESCED_EVENTS[event])), None)
+			elif self.policy == "drop" and event not in PROTECTED_EVENTS:
+				# both queues are in order, so this is the oldest droppable entry
+				self._droppable.popleft()
+			self.metrics["queue_depth"] = self._size
+			self._condition.notify_all()
+			return event, params
+
+	def close(self):
+		"""Stops accepting events. Those already queued can still be read with get"""
+		with self._condition:
+			self.closed = True
+			self._condition.notify_all()
+
+	def _drop_oldest(self):
+		if not self._droppable:
+			return False
+		entry = self._droppable.popleft()
+		entry[0] = entry[1] = None
+		self._size -= 1
+		self.metrics["queue_dropped"] += 1
+		return True
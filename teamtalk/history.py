@@ -0,0 +1,220 @@
+"""Searchable record of recent text messages.
+
+Keeps the last few messages of every channel and user within fixed limits, along with an index of the words, links and usernames in them, so questions like "what did this user say in the last 10 minutes?" or "who posted this link?" don't mean scanning everything."""
+
+# A part of PyTeamTalk
+# author: Carter Temm
+# License: MIT
+
+import collections
+import re
+import threading
+import time
+
+from teamtalk.teamtalk import USER_MSG, CHANNEL_MSG, BROADCAST_MSG, message_subscriptions
+
+
+_url_re = re.compile(r"(?:https?://|www\.)[^\s<>\"']+", re.IGNORECASE)
+_word_re = re.compile(r"\w+")
+
+
+def tokenize(content):
+	"""Returns the set of index keys for a message's content: ("url", link) for every link and ("word", word) for every other word, both casefolded"""
+	keys = set()
+	for url in _url_re.findall(content):
+		keys.add(("url", normalize_url(url)))
+	for word in _word_re.findall(_url_re.sub(" ", content)):
+		keys.add(("word", word.casefold()))
+	return keys
+
+
+def normalize_url(url):
+	"""Returns url the way it's indexed, so a link followed by punctuation still matches"""
+	return url.rstrip(".,;:!?)]}").casefold()
+
+
+class MessageHistory:
+	"""Remembers text messages received by a server, see attach
+	Each entry is a dict with the keys id (increasing with every message), time, type, chanid, srcuserid, destuserid, username, nickname and content
+	Limits, all of which are optional:
+		per_channel, per_user: how many messages to keep for each channel and each sender
+		max_entries: how many messages to keep overall
+		max_age: how many seconds to keep messages for
+		max_bytes: roughly how much message content to keep
+	Whichever limit is reached first evicts the oldest messages, which are removed from the index along with them
+	types lists the message types to record (teamtalk.USER_MSG and so on). Safe to use from any thread"""
+
+	def __init__(self, per_channel=1000, per_user=200, max_entries=10000, max_age=None, max_bytes=None, types=(USER_MSG, CHANNEL_MSG, BROADCAST_MSG)):
+		self.per_channel = per_channel
+		self.per_user = per_user
+		self.max_entries = max_entries
+		self.max_age = max_age
+		self.max_bytes = max_bytes
+		self.types = set(types)
+		self.lock = threading.Lock()
+		self.entries = collections.OrderedDict()
+		self.size = 0
+		# chanid and srcuserid -> ordered ids of their messages
+		self._channels = {}
+		self._users = {}
+		# index key -> ids, and id -> the keys it's indexed under
+		self._index = {}
+		self._keys = {}
+		self._next_id = 1
+		self.server = None
+
+	def __len__(self):
+		return len(self.entries)
+
+	@property
+	def sublocal(self):
+		"""The subscriptions needed to record messages, for TeamTalkServer.prune_subscriptions"""
+		return message_subscriptions(self.types)
+
+	def attach(self, server):
+		"""Starts recording messages delivered to server"""
+		if self.server is not None:
+			raise ValueError("Already attached to a server")
+		self.server = server
+		server.subscribe("messagedeliver", self._handle_messagedeliver)
+
+	def detach(self):
+		"""Stops recording messages. Those already recorded are kept"""
+		self.server.unsubscribe("messagedeliver", self._handle_messagedeliver)
+		self.server = None
+
+	def _handle_messagedeliver(self, server, params):
+		self.add(params)
+
+	def add(self, params):
+		"""Records a message from the parameters of a messagedeliver event, returning its entry, or None if its type isn't recorded"""
+		if params.get("type") not in self.types:
+			return None
+		sender = {}
+		if self.server is not None:
+			sender = self.server.user_indexes.records.get(params.get("srcuserid")) or {}
+		content = params.get("content", "")
+		entry = {
+			"time": time.time(),
+			"type": params["type"],
+			"chanid": params.get("chanid") if params["type"] == CHANNEL_MSG else None,
+			"srcuserid": params.get("srcuserid"),
+			"destuserid": params.get("destuserid"),
+			"username": sender.get("username", ""),
+			"nickname": sender.get("nickname", ""),
+			"content": content,
+		}
+		keys = tokenize(content)
+		if entry["username"]:
+			keys.add(("username", entry["username"].casefold()))
+		with self.lock:
+			id = self._next_id
+			self._next_id += 1
+			entry["id"] = id
+			self.entries[id] = entry
+			self.size += len(content)
+			self._keys[id] = keys
+			for key in keys:
+				self._index.setdefault(key, set()).add(id)
+			if entry["chanid"] is not None:
+				ring = self._channels.setdefault(entry["chanid"], collections.OrderedDict())
+				ring[id] = None
+				if self.per_channel is not None and len(ring) > self.per_channel:
+					self._evict(next(iter(ring)))
+			ring = self._users.setdefault(entry["srcuserid"], collections.OrderedDict())
+			ring[id] = None
+			if self.per_user is not None and len(ring) > self.per_user:
+				self._evict(next(iter(ring)))
+			self._trim()
+		return entry
+
+	def channel(self, chanid, since=None, limit=None):
+		"""Returns messages sent to a channel, oldest first
+		since is a number of seconds to look back, limit the most messages to return (the newest ones)"""
+		with self.lock:
+			self._trim()
+			ids = self._channels.get(chanid, ())
+			return self._select(list(ids), since, limit)
+
+	def user(self, userid, since=None, limit=None):
+		"""Returns messages sent by a user, identified by userid, oldest first. See channel"""
+		with self.lock:
+			self._trim()
+			ids = self._users.get(userid, ())
+			return self._select(list(ids), since, limit)
+
+	def search(self, text=None, url=None, username=None, chanid=None, since=None, limit=None):
+		"""Returns messages matching everything given, oldest first
+			text: every word in it appears in the message, in any order and case
+			url: the message contains this link
+			username: sent by this account, across sessions
+			chanid: sent to this channel
+		since and limit are as for channel. With none of the above, every message is searched"""
+		keys = []
+		if text:
+			words = [i for i in tokenize(text) if i[0] == "word"]
+			if not words:
+				return []
+			keys.extend(words)
+		if url:
+			keys.append(("url", normalize_url(url)))
+		if username:
+			keys.append(("username", username.casefold()))
+		with self.lock:
+			self._trim()
+			if keys:
+				sets = sorted((self._index.get(key, set()) for key in keys), key=len)
+				ids = set(sets[0]).intersection(*sets[1:])
+			else:
+				ids = self.entries.keys()
+			if chanid is not None:
+				channel = self._channels.get(chanid, {})
+				ids = [id for id in ids if id in channel]
+			return self._select(sorted(ids), since, limit)
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.size = 0
+			self._channels.clear()
+			self._users.clear()
+			self._index.clear()
+			self._keys.clear()
+
+	def _select(self, ids, since, limit):
+		entries = [self.entries[id] for id in ids]
+		if since is not None:
+			cutoff = time.time() - since
+			entries = [entry for entry in entries if entry["time"] >= cutoff]
+		if limit is not None:
+			entries = entries[-limit:] if limit else []
+		return entries
+
+	def _trim(self):
+		"""Evicts the oldest messages until every overall limit is met. Called with the lock held"""
+		cutoff = time.time() - self.max_age if self.max_age is not None else None
+		while self.entries:
+			oldest = next(iter(self.entries.values()))
+			if (
+				(self.max_entries is not None and len(self.entries) > self.max_entries)
+				or (self.max_bytes is not None and self.size > self.max_bytes)
+				or (cutoff is not None and oldest["time"] < cutoff)
+			):
+				self._evict(oldest["id"])
+			else:
+				break
+
+	def _evict(self, id):
+		entry = self.entries.pop(id)
+		self.size -= len(entry["content"])
+		for key in self._keys.pop(id):
+			ids = self._index[key]
+			ids.discard(id)
+			if not ids:
+				del self._index[key]
+		for rings, key in ((self._channels, entry["chanid"]), (self._users, entry["srcuserid"])):
+			ring = rings.get(key)
+			if ring is not None:
+				ring.pop(id, None)
+				if not ring:
+					del rings[key]
@@ -0,0 +1,282 @@
+"""Durable log of events and admin actions, for auditing.
+
+Handlers only append to an in-memory queue. A background thread writes what's queued in large batches, so logging adds next to nothing to the time spent handling messages.
+Files are JSON lines, optionally compressed as they're written, and are rotated by size and age. A manifest records the time range each finished file covers, so reading a range of time only opens the files that overlap it."""
+
+# A part of PyTeamTalk
+# author: Carter Temm
+# License: MIT
+
+import collections
+import gzip
+import io
+import json
+import os
+import threading
+import time
+import zlib
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+# raised when reading a compressed file that was never finished, because it's still being written or we crashed
+READ_ERRORS = (EOFError, zlib.error) + ((zstandard.ZstdError,) if zstandard else ())
+
+# events recorded by default
+JOURNAL_EVENTS = ("messagedeliver", "loggedin", "loggedout")
+
+# commands we send that count as admin actions
+ADMIN_COMMANDS = (
+	"kick",
+	"ban",
+	"unban",
+	"move",
+	"op",
+	"newaccount",
+	"delaccount",
+	"makechannel",
+	"updatechannel",
+	"removechannel",
+	"updateserver",
+	"saveconfig",
+)
+
+# never written to disk
+REDACTED_FIELDS = ("password", "oppassword")
+
+EXTENSIONS = {None: ".jsonl", "gzip": ".jsonl.gz", "zstd": ".jsonl.zst"}
+
+MANIFEST = "manifest.jsonl"
+
+
+class Journal:
+	"""Appends records to files in directory, see attach and record
+	A new file is started once the current one holds max_bytes (before compression) or is max_age seconds old
+	compression is None, "gzip" or "zstd", the last needing the zstandard package
+	Queued records are written every flush_interval seconds, or sooner once batch_size of them are waiting
+	metrics counts records, batches, bytes (before compression) and files written"""
+
+	def __init__(self, directory, max_bytes=64 * 1024 * 1024, max_age=86400, compression=None, flush_interval=1.0, batch_size=1000, prefix="journal"):
+		if compression not in EXTENSIONS:
+			raise ValueError("compression must be None, gzip or zstd")
+		if compression == "zstd" and zstandard is None:
+			raise ValueError("zstd compression requires the zstandard package")
+		self.directory = directory
+		self.max_bytes = max_bytes
+		self.max_age = max_age
+		self.compression = compression
+		self.flush_interval = flush_interval
+		self.batch_size = batch_size
+		self.prefix = prefix
+		self.metrics = {"records": 0, "batches": 0, "bytes": 0, "files": 0}
+		# appending to and popping from opposite ends of a deque is thread safe without locking
+		self._queue = collections.deque()
+		self._wakeup = threading.Event()
+		self._running = False
+		self._thread = None
+		self._file = None
+		self._handlers = {}
+
+	def start(self):
+		"""Starts the background writer. Returns immediately"""
+		os.makedirs(self.directory, exist_ok=True)
+		self._running = True
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+
+	def close(self):
+		"""Writes anything still queued, closes the current file and stops the writer"""
+		for server in list(self._handlers):
+			self.detach(server)
+		if not self._running:
+			return
+		self._running = False
+		self._wakeup.set()
+		self._thread.join()
+
+	def attach(self, server, name=None, events=JOURNAL_EVENTS, commands=ADMIN_COMMANDS):
+		"""Starts recording events received by server, and the commands in commands that we send to it
+		Records are tagged with name ("host:port" if None) so several servers can share a journal"""
+		name = name or f"{server.host}:{server.tcpport}"
+		handlers = []
+		for event in events:
+			handlers.append((event, self._event_handler(name, event)))
+		if commands:
+			commands = set(commands)
+
+			def sent(server, command, params):
+				if command in commands:
+					self.record("sent:" + command, params, name)
+
+			handlers.append(("sent", sent))
+		for event, func in handlers:
+			server.subscribe(event, func)
+		self._handlers[server] = handlers
+
+	def detach(self, server):
+		for event, func in self._handlers.pop(server):
+			server.unsubscribe(event, func)
+
+	def record(self, event, params, server=None):
+		"""Queues a record. Never blocks, so it's safe to call from message handlers
+		params is copied, with fields in REDACTED_FIELDS removed"""
+		params = {key: value for key, value in params.items() if key not in REDACTED_FIELDS}
+		self._queue.append((time.time(), server, event, params))
+		if len(self._queue) >= self.batch_size:
+			self._wakeup.set()
+
+	def _event_handler(self, name, event):
+		def handler(server, params):
+			self.record(event, params, name)
+		return handler
+
+	def _run(self):
+		try:
+			while self._running:
+				self._wakeup.wait(self.flush_interval)
+				self._wakeup.clear()
+				self._write_batch()
+			self._write_batch()
+		finally:
+			self._close_file()
+
+	def _write_batch(self):
+		queue = self._queue
+		count = len(queue)
+		if self._file and (time.time() - self._file["start"] >= self.max_age):
+			self._close_file()
+		if not count:
+			return
+		lines = []
+		first = None
+		for i in range(count):
+			when, server, event, params = queue.popleft()
+			if first is None:
+				first = when
+			lines.append(json.dumps({"time": when, "server": server, "event": event, "params": params}, separators=(",", ":"), default=str))
+		lines.append("")
+		data = "\n".join(lines).encode()
+		if self._file is None:
+			self._open_file(first)
+		file = self._file
+		file["stream"].write(data)
+		# compressed streams are flushed so every batch can be read back even if we never get to close the file
+		file["stream"].flush()
+		file["end"] = when
+		file["records"] += count
+		file["bytes"] += len(data)
+		self.metrics["records"] += count
+		self.metrics["batches"] += 1
+		self.metrics["bytes"] += len(data)
+		if file["bytes"] >= self.max_bytes:
+			self._close_file()
+
+	def _open_file(self, when):
+		stamp = time.strftime("%Y%m%d-%H%M%S", time.gmtime(when))
+		name = f"{self.prefix}-{stamp}-{self.metrics['files']:04d}{EXTENSIONS[self.compression]}"
+		raw = open(os.path.join(self.directory, name), "ab")
+		if self.compression == "gzip":
+			stream = gzip.GzipFile(fileobj=raw, mode="ab")
+		elif self.compression == "zstd":
+			stream = _ZstdWriter(raw)
+		else:
+			stream = raw
+		self._file = {"name": name, "raw": raw, "stream": stream, "start": time.time(), "first": when, "end": when, "records": 0, "bytes": 0}
+		self.metrics["files"] += 1
+
+	def _close_file(self):
+		file = self._file
+		if file is None:
+			return
+		self._file = None
+		if file["stream"] is not file["raw"]:
+			file["stream"].close()
+		file["raw"].close()
+		entry = {"file": file["name"], "start": file["first"], "end": file["end"], "records": file["records"], "bytes": file["bytes"]}
+		with open(os.path.join(self.directory, MANIFEST), "a") as f:
+			f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+
+class _ZstdWriter:
+	"""Streams zstd frames to a file, ending a block on every flush so what's been written so far is always readable"""
+
+	def __init__(self, raw):
+		self._writer = zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+
+	def write(self, data):
+		self._writer.write(data)
+
+	def flush(self):
+		self._writer.flush(zstandard.FLUSH_BLOCK)
+
+	def close(self):
+		self._writer.close()
+
+
+def _open_for_reading(path):
+	if path.endswith(".gz"):
+		return gzip.open(path, "rb")
+	if path.endswith(".zst"):
+		if zstandard is None:
+			raise ValueError("Reading " + path + " requires the zstandard package")
+		return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True))
+	return open(path, "rb")
+
+
+def _read_lines(path):
+	"""Yields the complete lines in a journal file, stopping at the last one in a file that was never finished"""
+	pending = b""
+	with _open_for_reading(path) as f:
+		while True:
+			try:
+				# read1 reads at most once, so nothing already decompressed is lost if the next read fails
+				chunk = f.read1(65536)
+			except READ_ERRORS:
+				return
+			if not chunk:
+				return
+			lines = (pending + chunk).split(b"\n")
+			# incomplete until its newline arrives
+			pending = lines.pop()
+			for line in lines:
+				if line:
+					yield line
+
+
+def read_journal(directory, start=None, end=None, events=None, server=None, prefix="journal"):
+	"""Yields the records (dicts with the keys time, server, event and params) written to directory between start and end, time.time() timestamps, in order
+	events and server optionally limit which records are returned. Commands we sent are recorded as "sent:<command>"
+	Finished files outside the range are skipped using the manifest. The file still being written, if any, is always read"""
+	manifest = {}
+	try:
+		with open(os.path.join(directory, MANIFEST)) as f:
+			for line in f:
+				if line.strip():
+					entry = json.loads(line)
+					manifest[entry["file"]] = entry
+	except FileNotFoundError:
+		pass
+	events = set(events) if events is not None else None
+	names = sorted(name for name in os.listdir(directory) if name.startswith(prefix + "-") and name.endswith(tuple(EXTENSIONS.values())))
+	for name in names:
+		entry = manifest.get(name)
+		if entry is not None and ((start is not None and entry["end"] < start) or (end is not None and entry["start"] > end)):
+			continue
+		for line in _read_lines(os.path.join(directory, name)):
+			try:
+				record = json.loads(line)
+			except ValueError:
+				# torn by a crash mid-write
+				continue
+			if start is not None and record["time"] < start:
+				continue
+			if end is not None and record["time"] > end:
+				# files are read oldest first, so there's nothing more to find
+				return
+			if events is not None and record["event"] not in events:
+				continue
+			if server is not None and record["server"] != server:
+				continue
+			yield record
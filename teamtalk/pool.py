@@ -0,0 +1,271 @@
+"""Several logins to one server, for sending more than one connection is allowed to.
+
+Servers limit how many commands each connection may send in a given time. A SessionPool keeps a few sessions logged in and spreads what's sent across them, while only one of them keeps track of the server's state.
+Private messages to any one user always go through the same session, so they arrive in the order they were sent."""
+
+# A part of PyTeamTalk
+# author: Carter Temm
+# License: MIT
+
+import collections
+import threading
+import time
+
+from teamtalk.teamtalk import TeamTalkServer, TeamTalkError, build_tt_message, USER_MSG, CUSTOM_MSG
+from teamtalk.sharding import pick_shard
+
+# events secondary sessions still handle themselves, as they describe the session rather than the server
+SESSION_EVENTS = ("error", "begin", "end", "accepted", "serverupdate")
+
+# state secondary sessions take from the primary rather than tracking it themselves
+SHARED_STATE = ("users", "user_indexes", "nicknames", "channels")
+
+# messages addressed to a session in particular, which secondaries pass on to handlers
+DIRECT_MESSAGES = (USER_MSG, CUSTOM_MSG)
+
+
+class _Slot:
+	__slots__ = ("number", "server", "ready", "lock", "times", "thread")
+
+	def __init__(self, number):
+		self.number = number
+		self.server = None
+		self.ready = threading.Event()
+		# serializes sending, so lines picked for this session go out in order
+		self.lock = threading.Lock()
+		# monotonic times of commands sent within the last second
+		self.times = collections.deque()
+		self.thread = None
+
+
+class SessionPool:
+	"""Keeps size sessions logged in to the same server, see start
+	Session 0 is the primary. It tracks the server's state and runs handlers for every event, see subscribe. The others don't track state, and look users and channels up in the primary's instead
+	Sessions that fail are replaced reconnect seconds later. While the primary is being replaced, users and channels can't be looked up by name
+	rate, if given, is the most commands any one session sends per second. Callers wait for room rather than go over
+	The server has to allow size logins from the account and address
+	metrics counts commands sent, failed sends and reconnects"""
+
+	def __init__(self, host, tcpport=10333, udpport=0, use_ssl=False, nickname="", username="", password="", client="PyTeamTalk", size=4, rate=None, reconnect=5, timeout=30):
+		if size < 1:
+			raise ValueError("size must be at least 1")
+		self.host = host
+		self.tcpport = tcpport
+		self.udpport = udpport
+		self.use_ssl = use_ssl
+		self.nickname = nickname
+		self.username = username
+		self.password = password
+		self.client = client
+		self.rate = rate
+		self.reconnect = reconnect
+		self.timeout = timeout
+		self.subscriptions = {}
+		self.metrics = {"sent": 0, "failures": 0, "reconnects": 0}
+		self.lock = threading.Lock()
+		self._slots = [_Slot(i) for i in range(size)]
+		self._stop = threading.Event()
+
+	@property
+	def primary(self):
+		"""The TeamTalkServer tracking state, for looking things up"""
+		return self._slots[0].server
+
+	@property
+	def sessions(self):
+		"""The sessions currently logged in"""
+		return [slot.server for slot in self._slots if slot.ready.is_set()]
+
+	def start(self, wait=True):
+		"""Logs every session in from threads of their own
+		If wait is True, blocks until the primary has logged in, raising ConnectionError if it doesn't within timeout seconds"""
+		self._stop.clear()
+		# the primary comes first, so secondaries have its state to share
+		for slot in self._slots:
+			self._new_session(slot)
+		for slot in self._slots:
+			slot.thread = threading.Thread(target=self._run, args=(slot,), daemon=True, name=f"session {slot.number}")
+			slot.thread.start()
+		if wait and not self._slots[0].ready.wait(self.timeout):
+			self.close()
+			raise ConnectionError(f"Couldn't log in to {self.host}:{self.tcpport}")
+
+	def close(self):
+		"""Disconnects every session"""
+		self._stop.set()
+		for slot in self._slots:
+			server = slot.server
+			if server and server.con and not server.disconnecting:
+				server.disconnect()
+		for slot in self._slots:
+			if slot.thread is not None:
+				slot.thread.join(self.timeout)
+				slot.thread = None
+
+	def subscribe(self, event, func=None):
+		"""Like TeamTalkServer.subscribe, calling func with the session the event came from
+		Events come from the primary, except for private and custom messages, which come from whichever session they were sent to. Replying through that session (or user_message) keeps a conversation in order
+		Can be used as a decorator"""
+		def wrapper(_func):
+			with self.lock:
+				self.subscriptions.setdefault(event.lower(), []).append(_func)
+			return _func
+		if func:
+			return wrapper(func)
+		return wrapper
+
+	def unsubscribe(self, event, func):
+		with self.lock:
+			self.subscriptions[event.lower()].remove(func)
+
+	def user_message(self, to, content):
+		"""Sends a private message through the session picked for the recipient, returning that session
+		to is anything accepted by TeamTalkServer.get_user"""
+		userid = to
+		if not isinstance(to, int):
+			userid = (self.primary.get_user(to) or {}).get("userid")
+			if userid is None:
+				raise ValueError(f"No such user: {to}")
+		line = build_tt_message("message", {"type": USER_MSG, "content": content, "destuserid": userid})
+		return self._through(userid, lambda server: server.send(line))
+
+	def send(self, line, key=None):
+		"""Sends a line through one of the sessions, returning the session it went through
+		Lines with the same key go through the same session while it's up, keeping them in order. Without one, the least busy session is used"""
+		return self._through(key, lambda server: server.send(line))
+
+	def call(self, method, *args, **kwargs):
+		"""Calls the TeamTalkServer method named method (e.g. "kick" or "move") on the least busy session
+		Only for commands that don't wait for a reply, as secondaries drop events about the server's state. Returns the session used"""
+		return self._through(None, lambda server: getattr(server, method)(*args, **kwargs))
+
+	def load(self, server):
+		"""Returns how many commands the given session sent in the last second"""
+		for slot in self._slots:
+			if slot.server is server:
+				return len(slot.times)
+		return 0
+
+	def _through(self, key, func):
+		"""Runs func with the session picked for key, trying another if the first has failed"""
+		for attempt in range(2):
+			slot = self._pick(key)
+			server = slot.server
+			error = None
+			try:
+				with slot.lock:
+					# send returns False rather than sending once a session is on its way out
+					sent = not server.disconnecting
+					if sent:
+						self._wait_for_room(slot)
+						sent = func(server) is not False
+			except OSError as exc:
+				error = exc
+				sent = False
+			if sent:
+				with self.lock:
+					self.metrics["sent"] += 1
+				return server
+			with self.lock:
+				self.metrics["failures"] += 1
+			# the session's thread notices and replaces it
+			slot.ready.clear()
+			if server.con and not server.disconnecting:
+				server.disconnect()
+			if attempt:
+				if error is not None:
+					raise error
+				raise ConnectionError(f"Couldn't send to {self.host}:{self.tcpport}")
+
+	def _pick(self, key):
+		deadline = time.monotonic() + self.timeout
+		while True:
+			ready = [slot.number for slot in self._slots if slot.ready.is_set()]
+			if ready:
+				break
+			if self._stop.is_set() or time.monotonic() >= deadline:
+				raise ConnectionError(f"No sessions are logged in to {self.host}:{self.tcpport}")
+			self._stop.wait(0.05)
+		if key is not None:
+			return self._slots[pick_shard(key, ready)]
+		return min((self._slots[number] for number in ready), key=lambda slot: len(slot.times))
+
+	def _wait_for_room(self, slot):
+		"""Records a command about to be sent by slot, first waiting until that's allowed by rate. Called with slot.lock held"""
+		times = slot.times
+		now = time.monotonic()
+		while times and now - times[0] >= 1:
+			times.popleft()
+		if self.rate and len(times) >= self.rate:
+			time.sleep(times[0] + 1 - now)
+			now = time.monotonic()
+			times.popleft()
+		times.append(now)
+
+	def _new_session(self, slot):
+		server = TeamTalkServer(self.host, self.tcpport, self.udpport, use_ssl=self.use_ssl)
+		with self.lock:
+			if slot.number == 0:
+				server.subscribe("*", self._forward)
+				for other in self._slots[1:]:
+					if other.server is not None:
+						self._share_state(other.server, server)
+			else:
+				for event, funcs in list(server.subscriptions.items()):
+					if event not in SESSION_EVENTS:
+						for func in list(funcs):
+							server.unsubscribe(event, func)
+				server.subscribe("loggedout", self._handle_loggedout)
+				server.subscribe("messagedeliver", self._forward_direct)
+				self._share_state(server, self._slots[0].server)
+			slot.server = server
+		return server
+
+	def _share_state(self, server, primary):
+		for name in SHARED_STATE:
+			setattr(server, name, getattr(primary, name))
+
+	def _run(self, slot):
+		"""Keeps a session logged in until the pool is closed"""
+		server = slot.server
+		while not self._stop.is_set():
+			error = None
+			try:
+				server.connect(timeout=self.timeout)
+				server.login(self.nickname, self.username, self.password, self.client)
+				slot.ready.set()
+				while not server.disconnecting:
+					try:
+						server.handle_messages(timeout=None)
+					except TeamTalkError:
+						# e.g. a message to someone who had just logged out
+						continue
+			except Exception as exc:
+				error = exc
+			slot.ready.clear()
+			if server.con and not server.disconnecting:
+				server.disconnect()
+			if self._stop.is_set():
+				break
+			print(f"session {slot.number} to {self.host}:{self.tcpport} ended ({error or 'disconnected'}), reconnecting in {self.reconnect} seconds")
+			with self.lock:
+				self.metrics["reconnects"] += 1
+			if self._stop.wait(self.reconnect):
+				break
+			server = self._new_session(slot)
+
+	def _forward(self, server, event, params):
+		for func in self.subscriptions.get(event, ()):
+			func(server, params)
+		for func in self.subscriptions.get("*", ()):
+			func(server, event, params)
+
+	def _forward_direct(self, server, params):
+		if params.get("type") in DIRECT_MESSAGES:
+			self._forward(server, "messagedeliver", params)
+
+	def _handle_loggedout(self, server, params):
+		"""Stands in for the state handler secondaries drop, which disconnects once we've been logged out"""
+		if not params.get("userid") or params["userid"] == server.me.get("userid"):
+			server.logged_out = True
+			server.disconnect()
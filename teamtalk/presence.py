@@ -0,0 +1,127 @@
+"""Merged view of who is online across several servers.
+
+Answers questions like "where is this user logged in right now?" or "how many people are on each server?" without looking at every server's users."""
+
+# A part of PyTeamTalk
+# author: Carter Temm
+# License: MIT
+
+import threading
+
+from teamtalk.query import Index, Where, And
+
+
+PRESENCE_FIELDS = ("username", "nickname", "ipaddr")
+
+
+class PresenceIndex:
+	"""Keeps a single index of the users logged in on any number of TeamTalkServer instances.
+	Entries are copies of each user's attributes, with the name of the server they're on added as "server"
+	Updated incrementally from loggedin, loggedout and updateuser, which arrive on each server's own thread, so lookups are safe from any thread
+	A server's users are forgotten when it disconnects, and again when it logs in, as the server lists everyone online afterwards"""
+
+	def __init__(self, fields=PRESENCE_FIELDS):
+		# keyed by (server name, userid)
+		self.index = Index(fields)
+		self.servers = {}
+		self.lock = threading.RLock()
+		self._counts = {}
+		self._handlers = {}
+
+	def attach(self, server, name=None):
+		"""Starts tracking the users of server, identified by name ("host:port" if None)
+		Users already logged in are added straight away. Returns the name"""
+		name = name or f"{server.host}:{server.tcpport}"
+		if name in self.servers:
+			raise ValueError(name + " is already attached")
+		handlers = (
+			("loggedin", lambda server, params: self._add(name, server, params["userid"])),
+			("updateuser", lambda server, params: self._update(name, params)),
+			("loggedout", lambda server, params: self._remove(name, params.get("userid"))),
+			("accepted", lambda server, params: self._forget(name)),
+			("disconnected", lambda server, params: self._forget(name)),
+		)
+		# handlers wait for the lock, so they're applied on top of the snapshot rather than overwritten by it
+		with self.lock:
+			self.servers[name] = server
+			self._counts[name] = 0
+			self._handlers[name] = handlers
+			for event, func in handlers:
+				server.subscribe(event, func)
+			if not server.disconnecting:
+				for userid, user in server.snapshot().users.items():
+					self._insert(name, user)
+		return name
+
+	def detach(self, name):
+		"""Stops tracking the server attached under name, forgetting its users"""
+		with self.lock:
+			server = self.servers.pop(name)
+			handlers = self._handlers.pop(name)
+			del self._counts[name]
+			self._forget(name)
+		for event, func in handlers:
+			server.unsubscribe(event, func)
+
+	def find(self, *predicates, **fields):
+		"""Returns a list of entries matching all of the given predicates (see teamtalk.Where) and fields
+		e.g. find(username="bob") lists every server bob is logged into"""
+		predicates = list(predicates) + [Where(field, value) for field, value in fields.items()]
+		if not predicates:
+			raise ValueError("At least one predicate or field is required")
+		predicate = predicates[0] if len(predicates) == 1 else And(*predicates)
+		with self.lock:
+			return [dict(entry) for entry in self.index.find(predicate)]
+
+	def locate(self, username):
+		"""Returns the names of every server username is logged into"""
+		with self.lock:
+			return sorted({key[0] for key in self.index.keys_for("username", username)})
+
+	def online_counts(self):
+		"""Returns a dict of server name -> users online"""
+		with self.lock:
+			return dict(self._counts)
+
+	def total_online(self):
+		with self.lock:
+			return len(self.index)
+
+	def _add(self, name, server, userid):
+		# handlers run after the server's own, so the user is already complete
+		user = server.user_indexes.records.get(userid)
+		if user is not None:
+			self._insert(name, user)
+
+	def _insert(self, name, user):
+		entry = dict(user)
+		entry["server"] = name
+		key = (name, entry["userid"])
+		with self.lock:
+			if name not in self.servers:
+				return
+			if key not in self.index:
+				self._counts[name] += 1
+			self.index.add(key, entry)
+
+	def _forget(self, name):
+		"""Removes every entry for the server attached under name"""
+		with self.lock:
+			for key in [key for key in self.index.records if key[0] == name]:
+				self.index.remove(key)
+			if name in self._counts:
+				self._counts[name] = 0
+
+	def _update(self, name, params):
+		key = (name, params["userid"])
+		with self.lock:
+			entry = self.index.records.get(key)
+			if entry is None:
+				return
+			entry.update(params)
+			self.index.reindex(key)
+
+	def _remove(self, name, userid):
+		with self.lock:
+			if self.index.remove((name, userid)) is not None:
+				self._counts[name] -= 1
@@ -0,0 +1,256 @@
+"""Secondary indexes over server state.
+
+Lets questions such as "all users from this IP" or "all admins" be answered
+without scanning every user."""
+
+# A part of PyTeamTalk
+# author: Carter Temm
+# License: MIT
+
+import bisect
+import difflib
+import threading
+
+
+# user attributes indexed by TeamTalkServer
+USER_INDEX_FIELDS = ("ipaddr", "username", "usertype", "statusmode", "clientname")
+
+
+class Index:
+	"""Keeps records retrievable by the value of any of the given fields.
+	Records are stored by reference, so callers are expected to call reindex after changing a record in place.
+	Changes and find hold lock, so find can be used from any thread while another keeps the index up to date"""
+
+	def __init__(self, fields):
+		self.fields = tuple(fields)
+		self.lock = threading.RLock()
+		self.records = {}
+		# field -> value -> set of keys
+		self._buckets = {field: {} for field in self.fields}
+		# key -> {field: value} as last indexed, needed to unlink stale values
+		self._indexed = {}
+
+	def __len__(self):
+		return len(self.records)
+
+	def __contains__(self, key):
+		return key in self.records
+
+	def add(self, key, record):
+		"""Adds (or replaces) the record stored under key"""
+		with self.lock:
+			if key in self.records:
+				self.remove(key)
+			self.records[key] = record
+			self._indexed[key] = {}
+			self.reindex(key)
+
+	def remove(self, key):
+		"""Forgets the record stored under key, returning it if found"""
+		with self.lock:
+			record = self.records.pop(key, None)
+			for field, value in self._indexed.pop(key, {}).items():
+				self._unlink(field, value, key)
+			return record
+
+	def reindex(self, key):
+		"""Brings the indexes up to date with the current contents of the record stored under key"""
+		with self.lock:
+			record = self.records.get(key)
+			if record is None:
+				return
+			indexed = self._indexed[key]
+			for field in self.fields:
+				old = indexed.get(field)
+				new = record.get(field)
+				if old == new:
+					continue
+				if old is not None:
+					self._unlink(field, old, key)
+					del indexed[field]
+				if new is not None:
+					self._buckets[field].setdefault(new, set()).add(key)
+					indexed[field] = new
+
+	def clear(self):
+		with self.lock:
+			self.records.clear()
+			self._indexed.clear()
+			for buckets in self._buckets.values():
+				buckets.clear()
+
+	def keys_for(self, field, value):
+		"""Returns the set of keys whose field equals value.
+		The returned set must not be modified, and may change unless lock is held"""
+		return self._field(field).get(value, _EMPTY)
+
+	def values(self, field):
+		"""Returns every distinct value currently indexed for field"""
+		return self._field(field).keys()
+
+	def find(self, predicate):
+		"""Returns the records matching predicate, ordered by key"""
+		with self.lock:
+			return [self.records[key] for key in sorted(predicate.resolve(self))]
+
+	def _field(self, field):
+		buckets = self._buckets.get(field)
+		if buckets is None:
+			raise ValueError(f"{field!r} isn't indexed, the indexed fields are {', '.join(self.fields)} (for users, teamtalk.USER_INDEX_FIELDS)")
+		return buckets
+
+	def _unlink(self, field, value, key):
+		bucket = self._buckets[field].get(value)
+		if bucket is None:
+			return
+		bucket.discard(key)
+		if not bucket:
+			del self._buckets[field][value]
+
+
+_EMPTY = frozenset()
+
+
+class NicknameIndex:
+	"""Finds keys (userids, for instance) by nickname, ignoring case.
+	Supports exact matches, nicknames starting with some text and, for typos, the closest nicknames
+	Changes and lookups hold lock (a new RLock if None), so lookups can be made from any thread while another keeps the index up to date"""
+
+	def __init__(self, lock=None):
+		self.lock = lock or threading.RLock()
+		# key -> folded nickname
+		self._names = {}
+		# folded nickname -> set of keys
+		self._exact = {}
+		# (folded nickname, key), sorted so every nickname starting with some text is in one run
+		self._sorted = []
+
+	def __len__(self):
+		return len(self._names)
+
+	def add(self, key, nickname):
+		"""Indexes key under nickname, replacing any nickname it had before"""
+		folded = (nickname or "").casefold()
+		with self.lock:
+			if self._names.get(key) == folded:
+				return
+			self.remove(key)
+			self._names[key] = folded
+			self._exact.setdefault(folded, set()).add(key)
+			bisect.insort(self._sorted, (folded, key))
+
+	def remove(self, key):
+		with self.lock:
+			folded = self._names.pop(key, None)
+			if folded is None:
+				return
+			keys = self._exact[folded]
+			keys.discard(key)
+			if not keys:
+				del self._exact[folded]
+			i = bisect.bisect_left(self._sorted, (folded, key))
+			del self._sorted[i]
+
+	def clear(self):
+		with self.lock:
+			self._names.clear()
+			self._exact.clear()
+			self._sorted.clear()
+
+	def exact(self, nickname):
+		"""Returns the set of keys whose nickname is nickname, ignoring case"""
+		with self.lock:
+			return frozenset(self._exact.get(nickname.casefold(), _EMPTY))
+
+	def prefix(self, text):
+		"""Returns a list of keys whose nickname starts with text, ignoring case, ordered by nickname"""
+		folded = text.casefold()
+		keys = []
+		with self.lock:
+			i = bisect.bisect_left(self._sorted, (folded,))
+			while i < len(self._sorted) and self._sorted[i][0].startswith(folded):
+				keys.append(self._sorted[i][1])
+				i += 1
+		return keys
+
+	def fuzzy(self, text, limit=5, cutoff=0.6):
+		"""Returns a list of keys whose nickname is most similar to text, best first, for up to limit distinct nicknames
+		cutoff (0 to 1) is how similar a nickname needs to be to count"""
+		keys = []
+		with self.lock:
+			for name in difflib.get_close_matches(text.casefold(), self._exact.keys(), limit, cutoff):
+				keys.extend(sorted(self._exact[name]))
+		return keys
+
+
+class Predicate:
+	"""Base class for queries against an Index.
+	Predicates can be combined with &, | and ~"""
+
+	def resolve(self, index):
+		"""Returns the set of matching keys"""
+		raise NotImplementedError
+
+	def __and__(self, other):
+		return And(self, other)
+
+	def __or__(self, other):
+		return Or(self, other)
+
+	def __invert__(self):
+		return Not(self)
+
+
+class Where(Predicate):
+	"""Matches records where field equals any of values"""
+
+	def __init__(self, field, *values):
+		if not values:
+			raise ValueError("At least one value is required")
+		self.field = field
+		self.values = values
+
+	def resolve(self, index):
+		if len(self.values) == 1:
+			return index.keys_for(self.field, self.values[0])
+		keys = set()
+		for value in self.values:
+			keys |= index.keys_for(self.field, value)
+		return keys
+
+	def __repr__(self):
+		return f"Where({self.field!r}, {', '.join(repr(i) for i in self.values)})"
+
+
+class And(Predicate):
+	def __init__(self, *predicates):
+		self.predicates = predicates
+
+	def resolve(self, index):
+		sets = sorted((p.resolve(index) for p in self.predicates), key=len)
+		if not sets:
+			return set(index.records)
+		# start from the smallest set to keep intersections cheap
+		return set(sets[0]).intersection(*sets[1:])
+
+
+class Or(Predicate):
+	def __init__(self, *predicates):
+		self.predicates = predicates
+
+	def resolve(self, index):
+		keys = set()
+		for predicate in self.predicates:
+			keys |= predicate.resolve(index)
+		return keys
+
+
+class Not(Predicate):
+	"""Matches every record the wrapped predicate doesn't.
+	Unlike the others, this needs to look at every key"""
+
+	def __init__(self, predicate):
+		self.predicate = predicate
+
+	def resolve(self, index):
+		return index.records.keys() - self.predicate.resolve(index)
@@ -0,0 +1,261 @@
+"""Spreads many server connections across worker processes.
+
+A single process tracking hundreds of busy servers spends most of its time parsing, and is limited to one core while doing it.
+ShardedRunner runs TeamTalkServer sessions in a pool of worker processes instead. Each worker parses its own traffic and sends compact batches of state changes back to the coordinating process, which keeps a merged view of every server that can be queried without talking to the workers."""
+
+# A part of PyTeamTalk
+# author: Carter Temm
+# License: MIT
+
+import hashlib
+import multiprocessing
+import multiprocessing.connection
+import os
+import threading
+import traceback
+
+from teamtalk.teamtalk import TeamTalkServer
+from teamtalk.query import Index, Where, And, USER_INDEX_FIELDS
+from teamtalk.dispatch import STATE_EVENTS
+
+
+def server_key(spec):
+	"""Returns the "host:port" string identifying a session spec"""
+	return f"{spec['host']}:{spec.get('tcpport', 10333)}"
+
+
+def pick_shard(key, shards):
+	"""Returns which of shards a key belongs to, using rendezvous hashing.
+	shards is a number of shards, or a list of the shard numbers to choose from
+	The result is stable across processes and runs, and growing or shrinking the pool only moves the keys that have to move"""
+	def weight(shard):
+		return hashlib.blake2b(f"{shard}:{key}".encode(), digest_size=8).digest()
+	if isinstance(shards, int):
+		shards = range(shards)
+	return max(shards, key=weight)
+
+
+class ShardedRunner:
+	"""Runs TeamTalkServer sessions in a pool of worker processes, keeping a merged view of their state in this one.
+	specs is a list of dicts describing each session, with the keys host, tcpport, udpport, use_ssl, nickname, username, password and client. Sessions are identified by "host:port"
+	events lists any events other than STATE_EVENTS that should be passed back, e.g. ("messagedeliver",)
+	reconnect is how many seconds to wait before reconnecting a dropped session, or None to leave it disconnected
+	flush_interval is the longest workers hold on to changes before sending them, as they're batched to keep overhead down"""
+
+	def __init__(self, specs, workers=None, events=(), reconnect=30, flush_interval=0.05):
+		self.specs = list(specs)
+		self.workers = workers or os.cpu_count() or 1
+		self.events = tuple(events)
+		self.reconnect = reconnect
+		self.flush_interval = flush_interval
+		# host:port -> {"connected", "error", "server_params", "me", "channels": {chanid: channel}, "users": {userid: user}}
+		self.servers = {}
+		# keyed by (host:port, userid)
+		self.user_indexes = Index(USER_INDEX_FIELDS)
+		self.subscriptions = {}
+		self.lock = threading.RLock()
+		self._processes = []
+		self._stop = None
+		self._reader_thread = None
+
+	def start(self):
+		"""Starts the worker processes. Returns immediately"""
+		shards = [[] for i in range(self.workers)]
+		for spec in self.specs:
+			key = server_key(spec)
+			shards[pick_shard(key, self.workers)].append(spec)
+			self.servers[key] = _new_state()
+		self._stop = multiprocessing.Event()
+		connections = []
+		for specs in shards:
+			if not specs:
+				continue
+			reader, writer = multiprocessing.Pipe(duplex=False)
+			process = multiprocessing.Process(
+				target=_worker,
+				args=(writer, specs, STATE_EVENTS + self.events, self._stop, self.reconnect, self.flush_interval),
+				daemon=True,
+			)
+			process.start()
+			writer.close()
+			self._processes.append(process)
+			connections.append(reader)
+		self._reader_thread = threading.Thread(target=self._read, args=(connections,), daemon=True)
+		self._reader_thread.start()
+
+	def stop(self, timeout=5):
+		"""Asks every worker to disconnect and exit, waiting up to timeout seconds before killing them"""
+		if self._stop:
+			self._stop.set()
+		for process in self._processes:
+			process.join(timeout)
+			if process.is_alive():
+				process.terminate()
+		self._processes.clear()
+
+	def subscribe(self, event, func=None):
+		"""Calls func(key, params) every time event arrives from any session, key being the session's "host:port"
+		Besides STATE_EVENTS and those passed to the constructor, "connected" and "disconnected" are also sent as sessions come and go
+		Handlers run on a single thread in this process, after the merged state has been updated. Can be used as a decorator"""
+		def wrapper(_func):
+			self.subscriptions.setdefault(event.lower(), []).append(_func)
+			return _func
+		if func:
+			return wrapper(func)
+		return wrapper
+
+	def unsubscribe(self, event, func):
+		self.subscriptions[event.lower()].remove(func)
+
+	def get_users(self, key=None):
+		"""Returns a list of users on the session identified by key, or on every session if None"""
+		with self.lock:
+			if key is not None:
+				return list(self.servers[key]["users"].values())
+			return [user for state in self.servers.values() for user in state["users"].values()]
+
+	def find_users(self, *predicates, **fields):
+		"""Like TeamTalkServer.find_users, but across every session
+		Returns a list of (key, user) tuples"""
+		predicates = list(predicates) + [Where(field, value) for field, value in fields.items()]
+		predicate = predicates[0] if len(predicates) == 1 else And(*predicates)
+		with self.lock:
+			return [(key[0], self.user_indexes.records[key]) for key in sorted(predicate.resolve(self.user_indexes))]
+
+	def online_counts(self):
+		"""Returns a dict of "host:port" -> number of users online"""
+		with self.lock:
+			return {key: len(state["users"]) for key, state in self.servers.items()}
+
+	def _read(self, connections):
+		while connections:
+			for connection in multiprocessing.connection.wait(connections):
+				try:
+					batch = connection.recv()
+				except (EOFError, OSError):
+					connections.remove(connection)
+					continue
+				for key, event, params in batch:
+					self._apply(key, event, params)
+
+	def _apply(self, key, event, params):
+		with self.lock:
+			state = self.servers.setdefault(key, _new_state())
+			users = state["users"]
+			if event == "connected":
+				state["connected"] = True
+				state["error"] = None
+			elif event == "disconnected":
+				state["connected"] = False
+				state["error"] = params.get("error")
+				for userid in users:
+					self.user_indexes.remove((key, userid))
+				users.clear()
+				state["channels"].clear()
+			elif event == "accepted":
+				state["me"] = params
+			elif event == "serverupdate":
+				state["server_params"].update(params)
+			elif event in ("addchannel", "updatechannel"):
+				state["channels"].setdefault(params["chanid"], {}).update(params)
+			elif event == "removechannel":
+				state["channels"].pop(params["chanid"], None)
+			elif event == "loggedin":
+				users[params["userid"]] = params
+				self.user_indexes.add((key, params["userid"]), params)
+			elif event == "loggedout":
+				if users.pop(params.get("userid"), None) is not None:
+					self.user_indexes.remove((key, params["userid"]))
+			elif event in ("adduser", "updateuser", "removeuser"):
+				user = users.get(params["userid"])
+				if user is not None:
+					user.update(params)
+					if event == "removeuser":
+						user.pop("chanid", None)
+					self.user_indexes.reindex((key, params["userid"]))
+		for func in self.subscriptions.get(event, []):
+			try:
+				func(key, params)
+			except Exception:
+				# one broken handler shouldn't stop events from every session
+				traceback.print_exc()
+
+
+def _new_state():
+	return {"connected": False, "error": None, "server_params": {}, "me": {}, "channels": {}, "users": {}}
+
+
+def _worker(connection, specs, events, stop, reconnect, flush_interval):
+	"""Entry point of a worker process"""
+	outbox = []
+	lock = threading.Lock()
+	servers = {}
+
+	def forward(key, event, params):
+		with lock:
+			outbox.append((key, event, params))
+
+	def flush():
+		with lock:
+			if not outbox:
+				return
+			batch = outbox[:]
+			outbox.clear()
+		connection.send(batch)
+
+	threads = []
+	for spec in specs:
+		thread = threading.Thread(target=_run_session, args=(spec, events, forward, servers, stop, reconnect), daemon=True)
+		thread.start()
+		threads.append(thread)
+	try:
+		while not stop.wait(flush_interval):
+			flush()
+	except (BrokenPipeError, EOFError, KeyboardInterrupt):
+		pass
+	finally:
+		for server in list(servers.values()):
+			if server.con and not server.disconnecting:
+				server.disconnect()
+	# let sessions report that they've disconnected
+	for thread in threads:
+		thread.join(1)
+	try:
+		flush()
+	except OSError:
+		pass
+
+
+def _run_session(spec, events, forward, servers, stop, reconnect):
+	"""Keeps a single session connected until told to stop"""
+	key = server_key(spec)
+
+	def relay(event):
+		def handler(server, params):
+			# copied, as the original may be changed by the reader thread while waiting to be sent
+			forward(key, event, dict(params))
+		return handler
+
+	while not stop.is_set():
+		server = TeamTalkServer(spec["host"], spec.get("tcpport", 10333), spec.get("udpport", 0), use_ssl=spec.get("use_ssl", False))
+		servers[key] = server
+		for event in events:
+			server.subscribe(event, relay(event))
+		error = None
+		try:
+			server.connect(timeout=30)
+			forward(key, "connected", {})
+			server.login(
+				spec.get("nickname", ""),
+				spec.get("username", ""),
+				spec.get("password", ""),
+				spec.get("client", "PyTeamTalk"),
+			)
+			server.handle_messages(timeout=None)
+		except Exception as exc:
+			error = str(exc) or type(exc).__name__
+		if server.con and not server.disconnecting:
+			server.disconnect()
+		forward(key, "disconnected", {"error": error})
+		if reconnect is None or stop.wait(reconnect):
+			break
@@ -0,0 +1,121 @@
+"""Immutable, versioned views of server state.
+
+The thread handling messages changes TeamTalkServer.users and friends in place, so iterating over them from another thread is unsafe.
+Snapshots are safe to hold on to and read from any thread. Publishing a new one after a change only copies the part of the state that changed."""
+
+# A part of PyTeamTalk
+# author: Carter Temm
+# License: MIT
+
+from types import MappingProxyType
+
+
+class PersistentMap:
+	"""An immutable mapping.
+	set and delete return a new map, sharing all but one of its buckets with the original, so changes cost a fraction of a full copy"""
+
+	__slots__ = ("_buckets", "_len")
+	bucket_count = 64
+
+	def __init__(self, items=None):
+		buckets = [{} for i in range(self.bucket_count)]
+		length = 0
+		for key, value in (items or {}).items():
+			buckets[hash(key) % self.bucket_count][key] = value
+			length += 1
+		self._buckets = tuple(buckets)
+		self._len = length
+
+	@classmethod
+	def _new(cls, buckets, length):
+		instance = cls.__new__(cls)
+		instance._buckets = buckets
+		instance._len = length
+		return instance
+
+	def __len__(self):
+		return self._len
+
+	def __contains__(self, key):
+		return key in self._buckets[hash(key) % self.bucket_count]
+
+	def __getitem__(self, key):
+		return self._buckets[hash(key) % self.bucket_count][key]
+
+	def __iter__(self):
+		for bucket in self._buckets:
+			yield from bucket
+
+	def get(self, key, default=None):
+		return self._buckets[hash(key) % self.bucket_count].get(key, default)
+
+	def keys(self):
+		return iter(self)
+
+	def values(self):
+		for bucket in self._buckets:
+			yield from bucket.values()
+
+	def items(self):
+		for bucket in self._buckets:
+			yield from bucket.items()
+
+	def set(self, key, value):
+		"""Returns a copy of this map with key set to value"""
+		index = hash(key) % self.bucket_count
+		bucket = dict(self._buckets[index])
+		length = self._len if key in bucket else self._len + 1
+		bucket[key] = value
+		return self._new(self._buckets[:index] + (bucket,) + self._buckets[index + 1:], length)
+
+	def delete(self, key):
+		"""Returns a copy of this map without key, or this map if key isn't present"""
+		index = hash(key) % self.bucket_count
+		if key not in self._buckets[index]:
+			return self
+		bucket = dict(self._buckets[index])
+		del bucket[key]
+		return self._new(self._buckets[:index] + (bucket,) + self._buckets[index + 1:], self._len - 1)
+
+
+def freeze(record):
+	"""Returns a read-only copy of a dict"""
+	return MappingProxyType(dict(record))
+
+
+_EMPTY_RECORD = MappingProxyType({})
+
+
+class Snapshot:
+	"""A consistent, read-only view of a server's state, as returned by TeamTalkServer.snapshot()
+	users and channels are PersistentMaps of userid and chanid to read-only dicts. me and server_params are read-only dicts
+	version increases by one with every change, so two snapshots can be cheaply compared"""
+
+	__slots__ = ("version", "users", "channels", "me", "server_params")
+
+	def __init__(self, version=0, users=None, channels=None, me=_EMPTY_RECORD, server_params=_EMPTY_RECORD):
+		self.version = version
+		self.users = users if users is not None else PersistentMap()
+		self.channels = channels if channels is not None else PersistentMap()
+		self.me = me
+		self.server_params = server_params
+
+	def replace(self, **fields):
+		"""Returns the next version of this snapshot, with fields replaced"""
+		values = {i: getattr(self, i) for i in self.__slots__}
+		values.update(fields)
+		values["version"] = self.version + 1
+		return Snapshot(**values)
+
+	def get_user(self, userid):
+		return self.users.get(userid)
+
+	def get_channel(self, chanid):
+		return self.channels.get(chanid)
+
+	def get_users_in_channel(self, chanid=None):
+		"""Returns a list of users in the channel with the given chanid, or those not in any channel if None"""
+		return [user for user in self.users.values() if user.get("chanid") == chanid]
+
+	def __repr__(self):
+		return f"<Snapshot version={self.version} users={len(self.users)} channels={len(self.channels)}>"
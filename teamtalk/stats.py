@@ -0,0 +1,65 @@
+"""Small statistics helpers used for latency and throughput reporting."""
+
+# A part of PyTeamTalk
+# author: Carter Temm
+# License: MIT
+
+import collections
+
+
+def percentile(values, p):
+	"""Returns the p-th percentile (0-100) of values, which must already be sorted, interpolating between the closest ranks
+	Returns None if values is empty"""
+	if not values:
+		return None
+	if len(values) == 1:
+		return values[0]
+	rank = (len(values) - 1) * p / 100
+	low = int(rank)
+	high = min(low + 1, len(values) - 1)
+	return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def summarize(values, percentiles=(50, 90, 99)):
+	"""Returns a dict describing values: count, min, mean, max and the requested percentiles (as "p50" and so on)"""
+	values = sorted(values)
+	summary = {"count": len(values)}
+	if not values:
+		return summary
+	summary["min"] = values[0]
+	summary["mean"] = sum(values) / len(values)
+	for p in percentiles:
+		summary[f"p{p:g}"] = percentile(values, p)
+	summary["max"] = values[-1]
+	return summary
+
+
+class RollingHistogram:
+	"""Keeps the most recent size samples of something, such as round trip times, and describes their distribution
+	Safe to add to from one thread while reading from another"""
+
+	def __init__(self, size=256):
+		self.samples = collections.deque(maxlen=size)
+		# smoothed variation between consecutive samples, see add
+		self.jitter = 0.0
+		self.last = None
+
+	def __len__(self):
+		return len(self.samples)
+
+	def add(self, value):
+		if self.last is not None:
+			# same estimator as RTP interarrival jitter (RFC 3550), which reacts quickly without overreacting to a single spike
+			self.jitter += (abs(value - self.last) - self.jitter) / 16
+		self.last = value
+		self.samples.append(value)
+
+	def percentile(self, p):
+		"""Returns the p-th percentile of the current samples, or None if there are none"""
+		return percentile(sorted(self.samples), p)
+
+	def summary(self, percentiles=(50, 90, 99)):
+		"""Like summarize, with the current jitter added"""
+		summary = summarize(list(self.samples), percentiles)
+		summary["jitter"] = self.jitter
+		return summary
@@ -0,0 +1,173 @@
+"""Surveys many TeamTalk servers at once, reporting who is online on each.
+
+Each server is logged into, the login snapshot (channels and users) is recorded, and the connection is closed again as soon as it's complete.
+Servers are surveyed in parallel with an upper bound on how many are in flight, and each gets its own deadline so unresponsive hosts can't hold up the rest.
+
+usage: teamtalk-survey [-h] [-c CONFIG] [-s HOST:PORT] [-f {json,csv}] ...
+Servers can be given on the command line, or in a configuration file in the same format used by examples/check_servers.py"""
+
+# A part of PyTeamTalk
+# author: Carter Temm
+# License: MIT
+
+import argparse
+import configparser
+import csv
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from teamtalk.teamtalk import TeamTalkServer
+
+
+client_name = "TeamTalkSurvey"
+
+
+def load_config(file):
+	"""Reads servers from a check_servers.py style configuration file.
+	Returns a list of dicts"""
+	config = configparser.ConfigParser()
+	if not config.read(file):
+		raise FileNotFoundError(file + " does not exist")
+	servers = []
+	for section in config.sections():
+		servers.append({
+			"name": section,
+			"host": config.get(section, "host"),
+			"tcpport": config.getint(section, "tcpport", fallback=10333),
+			"udpport": config.getint(section, "udpport", fallback=0),
+			"encrypted": config.getboolean(section, "encrypted", fallback=False),
+			"nickname": config.get(section, "nickname", fallback=None),
+			"username": config.get(section, "username", fallback=None),
+			"password": config.get(section, "password", fallback=None),
+		})
+	return servers
+
+
+def parse_server(text):
+	"""Parses host[:port] given on the command line"""
+	host, sep, port = text.rpartition(":")
+	if not sep or not port.isdigit():
+		host, port = text, "10333"
+	return {"name": text, "host": host.strip("[]"), "tcpport": int(port), "udpport": 0, "encrypted": False}
+
+
+def survey_server(entry, timeout, nickname="", username="", password=""):
+	"""Logs into a single server and records its state, taking no longer than roughly timeout seconds.
+	Never raises, failures are reported in the returned dict"""
+	started = time.monotonic()
+	deadline = started + timeout
+	result = {"name": entry["name"], "host": entry["host"], "tcpport": entry["tcpport"], "status": "ok", "error": ""}
+	server = None
+
+	def cb(server, event, params):
+		if time.monotonic() >= deadline:
+			result["status"] = "timeout"
+			server.disconnect()
+
+	try:
+		# lookups are cached by teamtalk.transport.default_resolver, so servers sharing a host only look it up once
+		server = TeamTalkServer(entry["host"], entry["tcpport"], entry.get("udpport", 0), use_ssl=entry.get("encrypted", False))
+		if not server.connect(timeout=max(deadline - time.monotonic(), 0.1)):
+			raise ConnectionError("Unexpected welcome message, this may not be a TeamTalk 5 server")
+		server.login(
+			entry.get("nickname") or nickname,
+			entry.get("username") or username,
+			entry.get("password") or password,
+			client_name,
+			callback=cb,
+		)
+	except Exception as exc:
+		result["status"] = "timeout" if isinstance(exc, TimeoutError) else "error"
+		result["error"] = str(exc)
+	finally:
+		if server and server.con and not server.disconnecting:
+			server.disconnect()
+	result["elapsed"] = round(time.monotonic() - started, 3)
+	if server:
+		# where the time went, for servers that are slow to answer
+		result["timings"] = {phase: round(server.metrics[phase], 3) for phase in ("dns", "tcp", "tls_handshake", "welcome") if phase in server.metrics}
+	if server and result["status"] == "ok":
+		result.update(summarize(server))
+	return result
+
+
+def summarize(server):
+	"""Builds a dict describing the users and channels of a server we just logged into"""
+	myid = server.me.get("userid")
+	users = []
+	for user in server.users:
+		if user["userid"] == myid:
+			continue
+		channel = server.get_channel(user.get("chanid")) if user.get("chanid") else None
+		users.append({
+			"nickname": user.get("nickname", ""),
+			"username": user.get("username", ""),
+			"role": server.get_role(user),
+			"channel": channel["channel"] if channel else None,
+		})
+	return {
+		"servername": server.server_params.get("servername", ""),
+		"channels": len(server.channels),
+		"online": len(users),
+		"users": users,
+	}
+
+
+def survey(servers, timeout=10, workers=32, **credentials):
+	"""Surveys every server in servers (dicts as returned by load_config) in parallel.
+	Returns a list of results in the same order as servers"""
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		futures = [executor.submit(survey_server, entry, timeout, **credentials) for entry in servers]
+		return [future.result() for future in futures]
+
+
+csv_fields = ("name", "host", "tcpport", "status", "elapsed", "servername", "online", "channels", "error")
+
+
+def write_json(results, file):
+	json.dump(results, file, indent=1)
+	file.write("\n")
+
+
+def write_csv(results, file):
+	writer = csv.DictWriter(file, csv_fields, extrasaction="ignore")
+	writer.writeheader()
+	writer.writerows(results)
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(prog="teamtalk-survey", description="Summarizes users on a collection of TeamTalk servers")
+	parser.add_argument("-c", "--config", action="append", default=[], help="check_servers.py style configuration file, can be repeated")
+	parser.add_argument("-s", "--server", action="append", default=[], help="host[:port] to survey, can be repeated")
+	parser.add_argument("-f", "--format", choices=("json", "csv"), default="json")
+	parser.add_argument("-o", "--output", help="file to write results to, defaults to stdout")
+	parser.add_argument("-t", "--timeout", type=float, default=10, help="seconds allowed per server (default: %(default)s)")
+	parser.add_argument("-w", "--workers", type=int, default=32, help="servers surveyed at once (default: %(default)s)")
+	parser.add_argument("--nickname", default="", help="used for servers that don't specify their own")
+	parser.add_argument("--username", default="")
+	parser.add_argument("--password", default="")
+	args = parser.parse_args(argv)
+	servers = []
+	for file in args.config:
+		servers += load_config(file)
+	servers += [parse_server(i) for i in args.server]
+	if not servers:
+		parser.error("No servers given, use --config or --server")
+	started = time.monotonic()
+	results = survey(servers, args.timeout, args.workers, nickname=args.nickname, username=args.username, password=args.password)
+	elapsed = time.monotonic() - started
+	writer = write_json if args.format == "json" else write_csv
+	if args.output:
+		with open(args.output, "w", newline="") as f:
+			writer(results, f)
+	else:
+		writer(results, sys.stdout)
+	ok = sum(1 for i in results if i["status"] == "ok")
+	print(f"Surveyed {len(results)} servers ({ok} ok) in {elapsed:.2f}s", file=sys.stderr)
+	return 0 if ok == len(results) else 1
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,250 @@
+"""Simulates a crowd of clients on a TeamTalk server, for capacity planning.
+
+Each virtual client logs in, joins a random channel, then chats, changes status and hops between channels at configurable rates until the run is over.
+Channel messages carry the time they were sent, so clients receiving them can measure delivery latency. A report of throughput and latency is produced at the end.
+
+usage: teamtalk-swarm [-h] [-p PORT] [-c CLIENTS] [-d DURATION] ... host
+Only run this against servers you're responsible for."""
+
+# A part of PyTeamTalk
+# author: Carter Temm
+# License: MIT
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+
+from teamtalk.teamtalk import TeamTalkServer, TeamTalkError
+from teamtalk.stats import summarize
+
+
+class VirtualClient:
+	"""A single simulated client, driven entirely by timers on its own connection"""
+
+	def __init__(self, swarm, number):
+		self.swarm = swarm
+		self.number = number
+		self.random = random.Random(swarm.random.random())
+		self.server = TeamTalkServer(swarm.host, swarm.tcpport, use_ssl=swarm.use_ssl)
+		self.server.subscribe("messagedeliver", self.on_message)
+		self.sequence = 0
+		self.errors = 0
+
+	def run(self, started):
+		swarm = self.swarm
+		server = self.server
+		try:
+			began = time.perf_counter()
+			server.connect(timeout=swarm.timeout)
+			connected = time.perf_counter()
+			server.login(f"{swarm.nickname} {self.number}", swarm.username, swarm.password, swarm.client)
+			swarm.record("connect", connected - began)
+			swarm.record("login", time.perf_counter() - connected)
+		except Exception as exc:
+			swarm.failed(self, exc)
+			if server.con and not server.disconnecting:
+				server.disconnect()
+			return
+		self.join_random()
+		self.schedule(swarm.message_rate, self.send_message)
+		self.schedule(swarm.status_rate, self.change_status)
+		self.schedule(swarm.join_rate, self.join_random)
+		server.call_at(started + swarm.duration, server.disconnect)
+		while not server.disconnecting:
+			try:
+				server.handle_messages(timeout=None)
+			except TeamTalkError:
+				# e.g. a channel we tried to join was full, carry on
+				self.errors += 1
+			except (OSError, EOFError) as exc:
+				swarm.failed(self, exc)
+				break
+
+	def schedule(self, rate, func):
+		"""Runs func at random, exponentially distributed intervals averaging rate times per second"""
+		if not rate:
+			return
+
+		def run():
+			func()
+			self.server.call_later(self.random.expovariate(rate), run)
+
+		self.server.call_later(self.random.expovariate(rate), run)
+
+	def send_message(self):
+		if not self.server.me.get("chanid"):
+			return
+		self.sequence += 1
+		content = f"{self.swarm.tag} {self.number} {self.sequence} {time.perf_counter():.6f}"
+		self.server.channel_message(content)
+		self.swarm.count("sent")
+
+	def change_status(self):
+		self.server.change_status(self.random.choice((0, 1, 2)), "swarm")
+		self.swarm.count("status")
+
+	def join_random(self):
+		channels = [i for i in self.server.channels if not i.get("protected") and i["chanid"] != self.server.me.get("chanid")]
+		if channels:
+			self.server.join(self.random.choice(channels))
+			self.swarm.count("joins")
+
+	def on_message(self, server, params):
+		content = params.get("content", "")
+		if not content.startswith(self.swarm.tag + " "):
+			return
+		if params.get("srcuserid") == server.me.get("userid"):
+			# our own message coming back
+			return
+		try:
+			sent = float(content.rsplit(" ", 1)[1])
+		except ValueError:
+			return
+		self.swarm.record("latency", time.perf_counter() - sent)
+		self.swarm.count("delivered")
+
+
+class Swarm:
+	"""Runs clients virtual clients against a server for duration seconds.
+	Rates are per client, in events per second on average
+	Clients are started ramp seconds apart to avoid tripping the server's login flood protection"""
+
+	def __init__(
+		self,
+		host,
+		tcpport=10333,
+		clients=10,
+		duration=60,
+		message_rate=0.5,
+		status_rate=0.05,
+		join_rate=0.02,
+		ramp=0.05,
+		use_ssl=False,
+		nickname="swarm",
+		username="",
+		password="",
+		client="TeamTalkSwarm",
+		timeout=10,
+		seed=None,
+	):
+		self.host = host
+		self.tcpport = tcpport
+		self.clients = clients
+		self.duration = duration
+		self.message_rate = message_rate
+		self.status_rate = status_rate
+		self.join_rate = join_rate
+		self.ramp = ramp
+		self.use_ssl = use_ssl
+		self.nickname = nickname
+		self.username = username
+		self.password = password
+		self.client = client
+		self.timeout = timeout
+		self.random = random.Random(seed)
+		# identifies this run's messages, so several swarms can share a server
+		self.tag = f"swarm:{self.random.getrandbits(32):08x}"
+		self.lock = threading.Lock()
+		self.counters = {"sent": 0, "delivered": 0, "status": 0, "joins": 0}
+		self.samples = {"connect": [], "login": [], "latency": []}
+		self.errors = []
+
+	def count(self, name, amount=1):
+		with self.lock:
+			self.counters[name] += amount
+
+	def record(self, name, value):
+		with self.lock:
+			self.samples[name].append(value)
+
+	def failed(self, client, exc):
+		with self.lock:
+			self.errors.append(f"client {client.number}: {exc}")
+
+	def run(self):
+		"""Runs the swarm to completion, returning a report (see report)"""
+		started = time.monotonic()
+		wall_started = time.time()
+		threads = []
+		clients = []
+		for number in range(self.clients):
+			client = VirtualClient(self, number)
+			thread = threading.Thread(target=client.run, args=(wall_started,), daemon=True)
+			clients.append(client)
+			threads.append(thread)
+			thread.start()
+			time.sleep(self.ramp)
+		for thread in threads:
+			thread.join(max(started + self.duration + self.timeout - time.monotonic(), 0))
+		for client in clients:
+			if client.server.con and not client.server.disconnecting:
+				client.server.disconnect()
+		return self.report(time.monotonic() - started, clients)
+
+	def report(self, elapsed, clients):
+		"""Builds a dict summarizing the run. Times are in seconds"""
+		with self.lock:
+			counters = dict(self.counters)
+			report = {
+				"host": self.host,
+				"tcpport": self.tcpport,
+				"clients": self.clients,
+				"failed": len(self.errors),
+				"elapsed": elapsed,
+				"messages_sent": counters["sent"],
+				"messages_delivered": counters["delivered"],
+				"send_rate": counters["sent"] / elapsed,
+				"delivery_rate": counters["delivered"] / elapsed,
+				"status_changes": counters["status"],
+				"joins": counters["joins"],
+				"command_errors": sum(i.errors for i in clients),
+				"connect_time": summarize(self.samples["connect"]),
+				"login_time": summarize(self.samples["login"]),
+				"latency": summarize(self.samples["latency"]),
+				"errors": self.errors[:20],
+			}
+		return report
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(prog="teamtalk-swarm", description="Simulates many clients on a TeamTalk server and reports latency and throughput")
+	parser.add_argument("host")
+	parser.add_argument("-p", "--port", type=int, default=10333)
+	parser.add_argument("-c", "--clients", type=int, default=10)
+	parser.add_argument("-d", "--duration", type=float, default=60, help="seconds to run for (default: %(default)s)")
+	parser.add_argument("--message-rate", type=float, default=0.5, help="channel messages per second, per client (default: %(default)s)")
+	parser.add_argument("--status-rate", type=float, default=0.05, help="status changes per second, per client (default: %(default)s)")
+	parser.add_argument("--join-rate", type=float, default=0.02, help="channel changes per second, per client (default: %(default)s)")
+	parser.add_argument("--ramp", type=float, default=0.05, help="seconds between starting clients (default: %(default)s)")
+	parser.add_argument("--ssl", action="store_true", help="the server is encrypted")
+	parser.add_argument("--nickname", default="swarm")
+	parser.add_argument("--username", default="")
+	parser.add_argument("--password", default="")
+	parser.add_argument("--seed", type=int)
+	args = parser.parse_args(argv)
+	swarm = Swarm(
+		args.host,
+		args.port,
+		clients=args.clients,
+		duration=args.duration,
+		message_rate=args.message_rate,
+		status_rate=args.status_rate,
+		join_rate=args.join_rate,
+		ramp=args.ramp,
+		use_ssl=args.ssl,
+		nickname=args.nickname,
+		username=args.username,
+		password=args.password,
+		seed=args.seed,
+	)
+	report = swarm.run()
+	json.dump(report, sys.stdout, indent=1)
+	sys.stdout.write("\n")
+	return 0 if not report["failed"] else 1
+
+
+if __name__ == "__main__":
+	sys.exit(main())
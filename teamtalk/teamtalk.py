@@ -11,11 +11,20 @@ http://github.com/cartertemm/pyteamtalk
 import shlex
 import time
 import threading
-import telnetlib
-import socket
 import ssl
 import warnings
 import functools
+import collections
+import contextlib
+import traceback
+
+from teamtalk.query import Index, NicknameIndex, Where, And, USER_INDEX_FIELDS
+from teamtalk.cache import RecordCache
+from teamtalk.transport import Transport
+from teamtalk.timers import Scheduler
+from teamtalk.snapshot import Snapshot, freeze
+from teamtalk.dispatch import EventQueue
+from teamtalk.stats import RollingHistogram
 
 
 # constants
@@ -143,6 +152,35 @@ SUBSCRIBE_INTERCEPT_DESKTOP	 = 0x00400000
 SUBSCRIBE_INTERCEPT_MEDIAFILE = 0x01000000
 SUBSCRIBE_INTERCEPT_ALL = 0x017B0000
 
+# the local subscription needed to receive each type of message
+MESSAGE_SUBSCRIPTIONS = {
+	USER_MSG: SUBSCRIBE_USER_MSG,
+	CHANNEL_MSG: SUBSCRIBE_CHANNEL_MSG,
+	BROADCAST_MSG: SUBSCRIBE_BROADCAST_MSG,
+	CUSTOM_MSG: SUBSCRIBE_CUSTOM_MSG,
+}
+
+# what functions subscribed to these events are assumed to need, unless they say otherwise. See TeamTalkServer.prune_subscriptions
+EVENT_SUBSCRIPTIONS = {
+	"messagedeliver": SUBSCRIBE_USER_MSG | SUBSCRIBE_CHANNEL_MSG | SUBSCRIBE_BROADCAST_MSG | SUBSCRIBE_CUSTOM_MSG,
+	"*": SUBSCRIBE_LOCAL_DEFAULT,
+}
+
+# id of the subscribe and unsubscribe commands sent by prune_subscriptions
+SUBSCRIPTION_ID = 20
+
+# ids given to commands that change the account and ban lists when no other id is passed, so a failure only invalidates the cache it concerns
+ACCOUNT_CHANGE_ID = 11
+BAN_CHANGE_ID = 102
+
+
+def message_subscriptions(types):
+	"""Returns the local subscriptions needed to receive messages of the given types (USER_MSG and so on) as a bitmask"""
+	mask = SUBSCRIBE_NONE
+	for type in types:
+		mask |= MESSAGE_SUBSCRIPTIONS.get(type, SUBSCRIBE_NONE)
+	return mask
+
 
 def split_parts(msg):
 	"""Splits a key=value pair into a tuple."""
@@ -170,17 +208,63 @@ def split_quoted(message):
 	return final
 
 
+class InternTable:
+	"""Hands out a single shared copy of equal strings, so thousands of users with the same clientname (for instance) don't each hold their own.
+	Unlike sys.intern, the table holds at most maxsize strings. It keeps two generations: once the newer one fills up with half of maxsize it becomes the older one, and whatever wasn't used since is let go. Strings in use stay shared, while one-off values don't pile up"""
+
+	def __init__(self, maxsize=100000):
+		self.maxsize = maxsize
+		self._strings = {}
+		self._older = {}
+
+	def __call__(self, string):
+		strings = self._strings
+		try:
+			return strings[string]
+		except KeyError:
+			pass
+		# still in use, so carried over into the current generation
+		string = self._older.get(string, string)
+		if len(strings) >= self.maxsize // 2:
+			self._older = strings
+			strings = self._strings = {}
+		strings[string] = string
+		return string
+
+	def __len__(self):
+		return len(self._strings) + len(self._older)
+
+	def clear(self):
+		self._strings = {}
+		self._older = {}
+
+
+# shared by every parsed message, see parse_tt_message
+intern_table = InternTable()
+# parameters whose values tend to repeat across users and channels, and are worth interning
+INTERNED_PARAMS = frozenset((
+	"clientname",
+	"version",
+	"ipaddr",
+	"username",
+	"channel",
+	"chanpath",
+))
+
+
 def parse_tt_message(message):
 	"""Parses a message sent by Teamtalk.
 	Also preserves datatypes.
+	Event names, parameter names and values of parameters in INTERNED_PARAMS are interned through intern_table
 	Returns a tuple of (event, parameters)"""
 	params = {}
 	message = message.strip()
 	message = split_quoted(message)
-	event = message[0]
-	message.remove(event)
+	event = intern_table(message[0])
+	del message[0]
 	for item in message:
 		k, v = split_parts(item)
+		k = intern_table(k)
 		# Lists take the form [x,y,z]
 		if v.startswith("[") and v.endswith("]"):
 			v = v.strip("[]")
@@ -204,6 +288,8 @@ def parse_tt_message(message):
 		# strings
 		elif v.startswith('"') and v.endswith('"'):
 			v = v[1:-1]
+			if k in INTERNED_PARAMS:
+				v = intern_table(v)
 		params[k] = v
 	return event, params
 
@@ -235,6 +321,33 @@ def build_tt_message(event, params):
 	return message
 
 
+def create_ssl_context(verify=False, cafile=None, capath=None):
+	"""Creates an SSLContext suitable for connecting to TeamTalk servers.
+	Most servers use self-signed certificates, so by default they aren't verified. Pass verify=True to check them against the system's trusted CAs, or those in cafile/capath"""
+	if verify:
+		return ssl.create_default_context(cafile=cafile, capath=capath)
+	context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+	context.check_hostname = False
+	context.verify_mode = ssl.CERT_NONE
+	return context
+
+
+_default_ssl_context = None
+# (host, tcpport) -> (context, session) from the last encrypted connection, allowing reconnects to skip a full handshake
+_ssl_sessions = {}
+_ssl_lock = threading.Lock()
+
+
+def get_default_ssl_context():
+	"""Returns the SSLContext shared by every encrypted connection that wasn't given its own.
+	Created with create_ssl_context on first use"""
+	global _default_ssl_context
+	with _ssl_lock:
+		if _default_ssl_context is None:
+			_default_ssl_context = create_ssl_context()
+		return _default_ssl_context
+
+
 class TeamTalkError(Exception):
 	"""Raised on an error event from the server"""
 	def __init__(self, code, message):
@@ -242,18 +355,24 @@ class TeamTalkError(Exception):
 		self.message = message
 
 	def __str__(self):
-		return "[" + self.code + "]: " + self.message
+		return f"[{self.code}]: {self.message}"
 
 
 class TeamTalkServer:
 	"""Represents a single TeamTalk server."""
 
-	def __init__(self, host=None, tcpport=10333, udpport=0, use_ssl=False):
+	def __init__(self, host=None, tcpport=10333, udpport=0, use_ssl=False, ssl_context=None):
 		self.set_connection_info(host, tcpport, udpport, use_ssl)
+		# if None, encrypted connections use get_default_ssl_context()
+		self.ssl_context = ssl_context
+		# passed along to teamtalk.Transport, e.g. {"keepalive": True, "rcvbuf": 262144}
+		self.transport_options = {}
 		self.con = None
 		self.pinger_thread = None
 		self.message_thread = None
 		self.disconnecting = False
+		# whether "disconnected" is still to be sent for the current connection
+		self._connected = False
 		self.logging_in = False
 		self.logged_out = False
 		self.current_id = 0
@@ -261,19 +380,57 @@ class TeamTalkServer:
 		self.subscriptions = {}
 		self.channels = []
 		self.users = []
+		self.user_indexes = Index(USER_INDEX_FIELDS)
+		# sharing a lock, so a nickname looked up is still indexed when its record is fetched
+		self.nicknames = NicknameIndex(self.user_indexes.lock)
 		self.bans = []
+		self.ban_cache = RecordCache(self.bans, ("ipaddr", "username", "chanpath"))
 		self.accounts = []
+		self.account_cache = RecordCache(self.accounts, ("username",))
+		# command id -> the cache to invalidate if that command fails
+		self._cache_ids = {ACCOUNT_CHANGE_ID: self.account_cache, BAN_CHANGE_ID: self.ban_cache}
 		self.me = {}
 		self.server_params = {}
 		self.files = []
 		self.getting_accounts = False
 		self.getting_bans = False
+		# timings and counters describing this connection, e.g. metrics["tls_handshake"]
+		self.metrics = {}
+		# see call_later, call_every and call_at
+		self.timers = Scheduler()
+		self._snapshot = Snapshot()
+		# round trip times of pings in seconds, see handle_pings
+		self.rtt = RollingHistogram()
+		# when each ping still waiting for a pong was sent
+		self._pings = collections.deque()
+		# monotonic time anything was last sent, as the server only times us out if we go quiet
+		self._last_sent = 0
+		self._stopping = threading.Event()
+		# see start_dispatcher
+		self.event_queue = None
+		self.dispatcher_thread = None
+		self._internal_handlers = set()
+		# see teamtalk.watchdog.Watchdog.attach
+		self.watchdog = None
+		# the thread running handle_messages, if any, the monotonic time it last made progress and whether it's waiting for data. Watched by the watchdog
+		self._reader = None
+		self._heartbeat = 0
+		self._reading = False
+		# the local subscriptions users are being given, or None when not pruning. See prune_subscriptions
+		self.sublocal = None
+		self._subscription_lock = threading.Lock()
+		self._subscription_queue = set()
+		self._subscription_timer = None
+		self._update_timer = None
+		self._subscription_delay = 0.05
+		self._subscription_batch = 200
 		self._subscribe_to_internal_events()
 		self._login_sequence = 0
 
 
 	def set_connection_info(self, host, tcpport=10333, udpport=0, use_ssl=False):
-		"""Sets the server's host and TCP port"""
+		"""Sets the server's host and TCP port
+		If use_ssl is True, the connection is encrypted using self.ssl_context (see create_ssl_context)"""
 		self.host = host
 		self.tcpport = tcpport
 		self.use_ssl = use_ssl
@@ -282,25 +439,52 @@ class TeamTalkServer:
 		else:
 			self.udpport = udpport
 
-	def connect(self):
+	def connect(self, timeout=None):
 		"""Initiates the connection to this server
+		If timeout is specified, the whole process (looking up the host, connecting, the TLS handshake and waiting for the welcome message) must finish within that many seconds. Otherwise only the welcome message is waited on, for up to 3 seconds
+		IPv6 and IPv4 addresses are raced against each other, see teamtalk.Transport.connect. The time each phase took is recorded in self.metrics ("dns", "tcp", "tls_handshake" and "welcome", along with "connect" for the total) to help diagnose slow servers
 		Raises an exception on failure"""
+		started = time.perf_counter()
+		deadline = None if timeout is None else time.monotonic() + timeout
+
+		def remaining():
+			if deadline is None:
+				return None
+			left = deadline - time.monotonic()
+			if left <= 0:
+				raise TimeoutError(f"Couldn't connect to {self.host} within {timeout} seconds")
+			return left
+
+		self.con = Transport.connect((self.host, self.tcpport), timeout, **self.transport_options)
+		self._connected = True
+		self.metrics.update(self.con.timings)
+		self.metrics["address"] = self.con.sock.getpeername()[0]
 		if self.use_ssl:
-			context = ssl.SSLContext()
-			context.verify_mode = ssl.CERT_NONE
-			context.check_hostname = False
-			sock = socket.create_connection((self.host, self.tcpport))
-			self.con = context.wrap_socket(sock, server_hostname=self.host)
-		else:
-			self.con = telnetlib.Telnet(self.host, self.tcpport)
+			context = self.ssl_context or get_default_ssl_context()
+			session = None
+			cached = _ssl_sessions.get((self.host, self.tcpport))
+			# sessions can only be resumed by the context that created them
+			if cached and cached[0] is context:
+				session = cached[1]
+			handshake_started = time.perf_counter()
+			self.con.start_tls(context, self.host, session, remaining())
+			self.metrics["tls_handshake"] = time.perf_counter() - handshake_started
+			self.metrics["tls_resumed"] = self.con.session_reused
 		# the first thing we should get is a welcome message
-		welcome = self.read_line(timeout=3)
+		welcome_started = time.perf_counter()
+		welcome = self.read_line(timeout=3 if timeout is None else remaining())
+		self.metrics["welcome"] = time.perf_counter() - welcome_started
+		self.metrics["connect"] = time.perf_counter() - started
 		if not welcome:
 			raise TimeoutError("Server failed to send welcome message in time")
+		if self.use_ssl and self.con.session:
+			# TLS 1.3 only hands out sessions after the handshake, so wait until we've read something
+			_ssl_sessions[(self.host, self.tcpport)] = (context, self.con.session)
 		welcome = welcome.decode()
 		event, params = parse_tt_message(welcome)
 		if event == "teamtalk":
 			self.server_params = params
+			self._publish(server_params=freeze(params))
 			return True
 		else:
 			# error
@@ -340,39 +524,54 @@ class TeamTalkServer:
 		"""Reads and returns a line from the server"""
 		if self.disconnecting:
 			return False
-		if isinstance(self.con, telnetlib.Telnet):
-			return self.con.read_until(b"\r\n", timeout)
-		# For SSL connections, use recv to read data
-		buffer = b""
-		self.con.settimeout(timeout)
-		while True:
-			try:
-				chunk = self.con.recv(1)
-				if not chunk:
-					break
-				buffer += chunk
-				if b"\r\n" in buffer:
-					break
-			except socket.timeout:
-				break
-		return buffer
+		return self.con.read_line(timeout)
 
 	def send(self, line):
 		"""Sends a line to the server"""
+		return self.send_many((line,))
+
+	def send_many(self, lines):
+		"""Sends several lines to the server in a single write, without waiting for replies in between"""
 		if self.disconnecting:
 			return False
+		lines = [self._prepare_line(line) for line in lines]
+		if not lines:
+			return
+		self.con.write(b"".join(lines))
+		self._last_sent = time.monotonic()
+		sent = self.subscriptions.get("sent")
+		if sent:
+			for line in lines:
+				command, params = parse_tt_message(line.decode(errors="replace").strip())
+				for func in sent:
+					self._call(func, "sent", command, params)
+
+	def _prepare_line(self, line):
 		if isinstance(line, str):
 			line = line.encode()
 		line = line.replace(b"\n", b"\r")
 		if not line.endswith(b"\r\n"):
 			line += b"\r\n"
-		self.con.write(line)
+		return line
 
 	def disconnect(self):
 		"""Disconnect from this server.
 		Signals all threads to stop"""
 		self.disconnecting = True
+		self._stopping.set()
 		self.con.close()
+		self._connection_lost()
+		if self.event_queue:
+			# lets the dispatcher finish what's queued, then exit
+			self.event_queue.close()
+
+	def _connection_lost(self):
+		"""Calls the functions subscribed to "disconnected", once per connection"""
+		if not self._connected:
+			return
+		self._connected = False
+		for func in list(self.subscriptions.get("disconnected", ())):
+			self._call(func, "disconnected", {})
 
 	def handle_messages(self, timeout=1, callback=None):
 		"""Processes all incoming messages
@@ -380,70 +579,246 @@ class TeamTalkServer:
 		Please note: If timeout is None (or unspecified), the callback function may take a while to execute in instances when we aren't getting packets. This behavior may not be desirable for many applications.
 			If in doubt, set a timeout.
 			Also be wary of extremely small timeouts when handling larger lines
+		For periodic work, prefer call_every and friends. Timers scheduled with them run from this loop, which sleeps until either the next one is due or data arrives
 		"""
-		while not self.disconnecting:
-			if self._login_sequence == 2:
-				self._login_sequence = 0
-				break
-			line = self.read_line(timeout)
-			line = line.strip()
-			if line == b"pong":
-				# response to ping, which is handled internally
-				# we don't actually care about getting something back, we just send them to make the server happy
-				line = b"" # drop it
-			try:
-				line = line.decode()
-			except UnicodeDecodeError:
-				print("failed to decode line: " + line)
-				if callable(callback):
-					callback(self, "", {})
-				continue
-			if not line:
-				if callable(callback):
-					callback(self, "", {})
-				continue # nothing to do
-			event, params = parse_tt_message(line)
-			event = event.lower()
-			if event == "error":
-				# indicates success or irrelevance
-				if params["number"] == CMD_ERR_IGNORE or params["number"] == CMD_ERR_SUCCESS:
+		idle_since = time.monotonic()
+		try:
+			while not self.disconnecting:
+				self._reader = threading.get_ident()
+				self._heartbeat = time.monotonic()
+				if self._login_sequence == 2:
+					self._login_sequence = 0
+					break
+				delay = self.timers.run_due(self._call_timer if self.watchdog else None)
+				if self.disconnecting:
+					break
+				wait = timeout
+				if timeout is not None:
+					wait = max(idle_since + timeout - time.monotonic(), 0)
+				if delay is not None and (wait is None or delay < wait):
+					wait = delay
+				self._reading = True
+				try:
+					line = self.read_line(wait)
+				except (EOFError, OSError):
+					self._connection_lost()
+					raise
+				self._reading = False
+				self._heartbeat = time.monotonic()
+				if not line:
+					if timeout is None or time.monotonic() - idle_since < timeout:
+						# woken early to run a timer
+						continue
+					idle_since = time.monotonic()
+					if callable(callback):
+						self._call(callback, "", "", {})
 					continue
-				raise TeamTalkError(params["number"], params["message"])
-			# Call messages for the event if necessary
-			for func in self.subscriptions.get(event, []):
-				func(self, params)
-			# finally, call the callback
-			if callable(callback):
-				callback(self, event, params)
+				idle_since = time.monotonic()
+				line = line.strip()
+				if line == b"pong":
+					# response to ping, which is handled internally
+					if self._pings:
+						self.rtt.add(time.perf_counter() - self._pings.popleft())
+						self.metrics["rtt"] = self.rtt.last
+					line = b"" # drop it
+				try:
+					line = line.decode()
+				except UnicodeDecodeError:
+					print("failed to decode line: " + line)
+					if callable(callback):
+						self._call(callback, "", "", {})
+					continue
+				if not line:
+					if callable(callback):
+						self._call(callback, "", "", {})
+					continue # nothing to do
+				event, params = parse_tt_message(line)
+				event = event.lower()
+				if event == "error":
+					# indicates success or irrelevance
+					if params["number"] == CMD_ERR_IGNORE or params["number"] == CMD_ERR_SUCCESS:
+						continue
+					# the user may have logged out before our subscription changes reached the server
+					if self.current_id == SUBSCRIPTION_ID:
+						continue
+					# the command that failed may have been a change we already applied to a cache
+					cache = self._cache_ids.get(self.current_id)
+					if cache is not None:
+						cache.invalidate()
+					raise TeamTalkError(params["number"], params["message"])
+				self._dispatch(event, params)
+				# finally, call the callback
+				if callable(callback):
+					self._call(callback, event, event, params)
+		finally:
+			self._reader = None
+			self._reading = False
+			self._heartbeat = time.monotonic()
 
 
+	def _dispatch(self, event, params):
+		"""Calls the functions subscribed to event, followed by those subscribed to every event
+		With a dispatcher running, only internal handlers are called here and the event is queued for the rest"""
+		if self.event_queue is None:
+			for func in self.subscriptions.get(event, []):
+				self._call(func, event, params)
+			for func in self.subscriptions.get("*", []):
+				self._call(func, event, event, params)
+			return
+		queued = bool(self.subscriptions.get("*"))
+		for func in self.subscriptions.get(event, []):
+			if func in self._internal_handlers:
+				self._call(func, event, params)
+			else:
+				queued = True
+		if queued:
+			self.event_queue.put(event, params)
+
+	def start_dispatcher(self, maxsize=1000, policy="block"):
+		"""Moves subscribed functions onto a thread of their own, so slow handlers don't hold up reading from the server
+		State (users, channels and so on) is still updated as events are read, and pings and timers are unaffected. Events are passed to the dispatcher through a teamtalk.EventQueue holding at most maxsize of them
+		policy decides what happens when handlers fall that far behind: "block" waits for room, "drop" discards the oldest messages and other events that don't describe state, and "coalesce" merges queued updates to the same user, channel or server
+		Handlers may see state that is newer than the event they're handling. Queue depth, drops and merges are reported in metrics
+		Handlers calling get_bans or get_accounts let the queue grow past maxsize while they wait for the reply, rather than have the reader wait for them. Anything else that waits for the reader from a handler can deadlock with the block policy
+		Exceptions raised by handlers are printed rather than stopping the dispatcher"""
+		if self.event_queue is not None:
+			raise RuntimeError("The dispatcher is already running")
+		self.event_queue = EventQueue(maxsize, policy, self.metrics)
+		self.dispatcher_thread = threading.Thread(target=self._run_dispatcher, args=(self.event_queue,))
+		self.dispatcher_thread.daemon = True
+		self.dispatcher_thread.start()
+
+	def stop_dispatcher(self, timeout=None):
+		"""Runs handlers for events already queued, then goes back to running them as events are read"""
+		queue = self.event_queue
+		if queue is None:
+			return
+		self.event_queue = None
+		queue.close()
+		if self.dispatcher_thread is not threading.current_thread():
+			self.dispatcher_thread.join(timeout)
+		self.dispatcher_thread = None
+
+	def _run_dispatcher(self, queue):
+		while True:
+			item = queue.get()
+			if item is None:
+				break
+			event, params = item
+			for func in self.subscriptions.get(event, []):
+				if func in self._internal_handlers:
+					continue
+				try:
+					self._call(func, event, params)
+				except Exception:
+					traceback.print_exc()
+			for func in self.subscriptions.get("*", []):
+				try:
+					self._call(func, event, event, params)
+				except Exception:
+					traceback.print_exc()
+
+	def _call(self, func, event, *args):
+		"""Calls func(self, *args) for event, letting the watchdog (if any) know while it runs"""
+		watchdog = self.watchdog
+		if watchdog is None:
+			return func(self, *args)
+		watchdog.enter(self, func, event)
+		try:
+			return func(self, *args)
+		finally:
+			watchdog.exit()
+
+	def _call_timer(self, func, args):
+		watchdog = self.watchdog
+		if watchdog is None:
+			return func(*args)
+		watchdog.enter(self, func, "timer")
+		try:
+			return func(*args)
+		finally:
+			watchdog.exit()
+
+	def call_later(self, delay, func, *args):
+		"""Calls func(*args) after delay seconds.
+		Timers run from the thread handling messages, so they only fire while handle_messages (or login) is running
+		Returns a teamtalk.Timer, which can be cancelled
+		Safe to call from any thread"""
+		return self._schedule(time.monotonic() + delay, func, args)
+
+	def call_at(self, when, func, *args):
+		"""Like call_later, but calls func(*args) at when, a time.time() timestamp"""
+		return self._schedule(time.monotonic() + (when - time.time()), func, args)
+
+	def call_every(self, interval, func, *args, delay=None):
+		"""Calls func(*args) every interval seconds until cancelled, starting after delay seconds (interval if None).
+		Runs that are missed, for instance because a handler blocked, are skipped rather than made up for
+		Returns a teamtalk.Timer, see call_later"""
+		if interval <= 0:
+			raise ValueError("interval must be positive")
+		if delay is None:
+			delay = interval
+		return self._schedule(time.monotonic() + delay, func, args, interval)
+
+	def _schedule(self, when, func, args, interval=None):
+		timer, earliest = self.timers.schedule(when, func, args, interval)
+		if earliest and self.con:
+			# the message loop may be sleeping past when this is due
+			self.con.wakeup()
+		return timer
+
 	def _sleep(self, seconds):
 		"""Like time.sleep, but immediately halts execution if we need to disconnect from a server"""
-		starttime = time.time()
-		while not self.disconnecting and time.time() - starttime <= seconds:
-			time.sleep(0.005)
+		self._stopping.wait(seconds)
+
+	def ping(self):
+		"""Sends a ping, timing how long the server takes to answer (see self.rtt)"""
+		self._pings.append(time.perf_counter())
+		self.send("ping")
+		self.metrics["pings_sent"] = self.metrics.get("pings_sent", 0) + 1
+
+	def ping_interval(self):
+		"""Returns how long we can go without sending anything before pinging the server.
+		Starts from a fraction of the server's usertimeout. The more round trip times vary compared to their median, the more often we ping, both to measure them and so a delayed ping still arrives in time. Never less than half a second"""
+		# in case usertimeout was changed somehow
+		# logic from TTCom, which had a preferable approach to TT clients for what we're doing
+		# better safe than sorry
+		usertimeout = float(self.server_params["usertimeout"])
+		if usertimeout < 1:
+			return 0.3
+		elif usertimeout < 1.5:
+			return 0.5
+		interval = usertimeout * 0.75
+		if len(self.rtt) >= 4:
+			median = self.rtt.percentile(50)
+			jitter = self.rtt.jitter
+			if median > 0:
+				# jitter as large as the median itself pings five times as often
+				interval /= 1 + 4 * jitter / median
+			# leave enough room for a ping to get there even when it's one of the slow ones
+			margin = self.rtt.percentile(99) + 4 * jitter
+			interval = min(interval, usertimeout - margin)
+		return max(interval, 0.5)
 
 	def handle_pings(self):
-		"""Handles pinging the server at a reasonable interval.
-		Intervals are calculated based on the server's usertimeout value.
+		"""Keeps the connection alive by pinging the server when nothing else has been sent for ping_interval seconds, timing the round trips as it goes.
+		Any other command resets the server's timer, so pings are skipped while we're busy sending.
 		This function always runs in it's own thread."""
-		pingtime = 0
 		while not self.disconnecting:
-			self.send("ping")
-			# in case usertimeout was changed somehow
-			# logic from TTCom, which had a preferable approach to TT clients for what we're doing
-			# better safe than sorry
-			pingtime = float(self.server_params["usertimeout"])
-			if pingtime < 1:
-				pingtime = 0.3
-			elif pingtime < 1.5:
-				pingtime = 0.5
+			interval = self.ping_interval()
+			idle = time.monotonic() - self._last_sent
+			if idle >= interval:
+				self.ping()
+				idle = 0
 			else:
-				pingtime *= 0.75
-			self._sleep(pingtime)
+				self.metrics["pings_skipped"] = self.metrics.get("pings_skipped", 0) + 1
+			self._sleep(interval - idle)
 
 	def subscribe(self, event, func=None):
 		"""Starts calling func every time event is encountered, passing along a copy of this class as well as the parameters from the TT message
+		If event is "*", func is called for every event as func(server, event, params), after any functions subscribed to that event
+		If event is "sent", func is called for every command we send as func(server, command, params), from the thread that sent it
+		If event is "disconnected", func is called as func(server, {}) once the connection is closed or lost, from the thread that noticed
 		This can also be used as a decorator
 		"""
 
@@ -455,6 +830,8 @@ class TeamTalkServer:
 				self.subscriptions[evt].append(_func)
 			else:
 				self.subscriptions[evt] = [_func]
+			if self.sublocal is not None:
+				self._schedule_update()
 			return _func
 
 		if func:
@@ -467,6 +844,94 @@ class TeamTalkServer:
 		Raises a KeyError or ValueError on failure"""
 		event = event.lower()
 		self.subscriptions[event].remove(func)
+		if self.sublocal is not None:
+			self._schedule_update()
+
+	def required_subscriptions(self):
+		"""Returns the local subscriptions (a SUBSCRIBE_* bitmask) the functions subscribed to events need, see prune_subscriptions"""
+		mask = SUBSCRIBE_NONE
+		# copied, as functions may be subscribed from other threads meanwhile
+		for event, funcs in list(self.subscriptions.items()):
+			for func in list(funcs):
+				if func in self._internal_handlers:
+					continue
+				needed = getattr(func, "sublocal", None)
+				if needed is None:
+					# methods can take it from the object they belong to
+					needed = getattr(getattr(func, "__self__", None), "sublocal", None)
+				if needed is None:
+					needed = EVENT_SUBSCRIPTIONS.get(event, SUBSCRIBE_NONE)
+				mask |= needed
+		return mask
+
+	def prune_subscriptions(self, enabled=True, delay=0.05, batch=200):
+		"""Unsubscribes from the messages no subscribed function needs, so the server doesn't send them
+		While enabled, every user's local subscriptions (see subscribe_to) are set to required_subscriptions() as they log in, and again for everyone whenever subscribe or unsubscribe change what's needed. Only the subscriptions in SUBSCRIBE_LOCAL_DEFAULT are ever removed
+		A function can say what it needs with a sublocal attribute holding a bitmask (see message_subscriptions), which methods may also take from their object. Otherwise messagedeliver handlers are assumed to want every type of message, "*" handlers everything, and other handlers nothing
+		Changes are collected for delay seconds, then sent at most batch at a time without waiting for replies. Like timers, they're sent while handle_messages (or login) is running
+		Disabling subscribes everyone to SUBSCRIBE_LOCAL_DEFAULT again"""
+		self._subscription_delay = delay
+		self._subscription_batch = batch
+		if enabled:
+			self.sublocal = self.required_subscriptions()
+		elif self.sublocal is None:
+			return
+		else:
+			self.sublocal = None
+		# users are added and removed by the thread handling messages, so they're gone through from there
+		self.call_later(0, self._queue_everyone)
+
+	def _schedule_update(self):
+		"""Works out what's needed again from the thread handling messages, once however many functions were subscribed meanwhile"""
+		with self._subscription_lock:
+			if self._update_timer is None:
+				self._update_timer = self.call_later(0, self._update_subscriptions)
+
+	def _update_subscriptions(self):
+		with self._subscription_lock:
+			self._update_timer = None
+		if self.sublocal is None:
+			return
+		sublocal = self.required_subscriptions()
+		if sublocal != self.sublocal:
+			self.sublocal = sublocal
+			self._queue_everyone()
+
+	def _queue_everyone(self):
+		self._queue_subscriptions(list(self.user_indexes.records))
+
+	def _queue_subscriptions(self, userids):
+		with self._subscription_lock:
+			self._subscription_queue.update(userids)
+			if self._subscription_queue and self._subscription_timer is None:
+				self._subscription_timer = self.call_later(self._subscription_delay, self._flush_subscriptions)
+
+	def _flush_subscriptions(self):
+		with self._subscription_lock:
+			userids = [self._subscription_queue.pop() for i in range(min(self._subscription_batch, len(self._subscription_queue)))]
+			self._subscription_timer = None
+			if self._subscription_queue:
+				self._subscription_timer = self.call_later(self._subscription_delay, self._flush_subscriptions)
+		wanted = self.sublocal if self.sublocal is not None else SUBSCRIBE_LOCAL_DEFAULT
+		lines = []
+		for userid in userids:
+			user = self.user_indexes.records.get(userid)
+			if user is None or userid == self.me.get("userid"):
+				continue
+			current = user.get("sublocal")
+			if current is None:
+				add = wanted
+				remove = SUBSCRIBE_LOCAL_DEFAULT & ~wanted
+			else:
+				add = wanted & ~current
+				remove = current & ~wanted & SUBSCRIBE_LOCAL_DEFAULT
+			if add:
+				lines.append(build_tt_message("subscribe", {"userid": userid, "sublocal": add, "id": SUBSCRIPTION_ID}))
+			if remove:
+				lines.append(build_tt_message("unsubscribe", {"userid": userid, "sublocal": remove, "id": SUBSCRIPTION_ID}))
+		if lines:
+			self.metrics["subscription_commands"] = self.metrics.get("subscription_commands", 0) + len(lines)
+			self.send_many(lines)
 
 	def _subscribe_to_internal_events(self):
 		"""Subscribes to all internal events that keep track of the server's state.
@@ -478,6 +943,7 @@ class TeamTalkServer:
 			event = func.replace("_handle_", "")
 			func = getattr(self, func)
 			if callable(func):
+				self._internal_handlers.add(func)
 				self.subscribe(event, func)
 
 	def get_channel(self, id, index=False):
@@ -507,6 +973,7 @@ class TeamTalkServer:
 		If index is False, returns a dict. Otherwise, returns the user's index in self.users
 		If id is of type str, look for matching nicknames
 			Be careful, though, as teamtalk imposes no limit on users with identical nicknames.
+			find_users_by_nickname returns every match, and can ignore case or match partial nicknames
 		If id is an int, look for matching userids
 		If id is a dict, we assume params are lazily being passed and try searching for a userid
 		"""
@@ -514,6 +981,14 @@ class TeamTalkServer:
 			id = id.get("userid")
 			if not id:
 				return
+		if isinstance(id, str) and not index:
+			# userids grow as users log in, so the lowest is the first in self.users
+			records = self.user_indexes.records
+			with self.nicknames.lock:
+				matches = [userid for userid in self.nicknames.exact(id) if records.get(userid, {}).get("nickname") == id]
+				if matches:
+					return records.get(min(matches))
+			return
 		found = False
 		for i, user in enumerate(self.users):
 			if isinstance(id, int) and user["userid"] == id:
@@ -554,6 +1029,67 @@ class TeamTalkServer:
 				else:
 					return file
 
+	def snapshot(self):
+		"""Returns a teamtalk.Snapshot, a read-only view of this server's users, channels, me and server_params as of the last event handled
+		Unlike the attributes themselves, snapshots are safe to read from any thread and never change once taken. Taking one is O(1)"""
+		return self._snapshot
+
+	def _publish(self, **fields):
+		self._snapshot = self._snapshot.replace(**fields)
+
+	def _publish_user(self, userid):
+		"""Publishes a snapshot reflecting the current state of the given user, who may have logged out"""
+		user = self.user_indexes.records.get(userid)
+		users = self._snapshot.users
+		if user is None:
+			users = users.delete(userid)
+		else:
+			users = users.set(userid, freeze(user))
+		self._publish(users=users)
+
+	def _publish_channel(self, chanid):
+		"""Publishes a snapshot reflecting the current state of the given channel, which may have been removed"""
+		channel = self.get_channel(chanid)
+		channels = self._snapshot.channels
+		if channel is None:
+			channels = channels.delete(chanid)
+		else:
+			channels = channels.set(chanid, freeze(channel))
+		self._publish(channels=channels)
+
+	def find_users(self, *predicates, **fields):
+		"""Retrieves a list of users matching all of the given predicates, using indexes rather than scanning self.users.
+		Keyword arguments are shorthand for equality, e.g. find_users(ipaddr="1.2.3.4", usertype=USERTYPE_ADMIN)
+		Predicates (teamtalk.Where, combined with &, | and ~) allow anything more involved:
+			find_users(Where("usertype", USERTYPE_ADMIN) | Where("username", "bob", "alice"))
+		Indexed attributes are listed in teamtalk.USER_INDEX_FIELDS
+		Results are ordered by userid"""
+		predicates = list(predicates)
+		for field, value in fields.items():
+			predicates.append(Where(field, value))
+		if len(predicates) == 1:
+			return self.user_indexes.find(predicates[0])
+		return self.user_indexes.find(And(*predicates))
+
+	def find_users_by_nickname(self, nickname, match="exact", limit=5):
+		"""Retrieves a list of users by nickname, ignoring case, without scanning self.users
+		match is one of:
+			"exact": the whole nickname matches, ordered by userid
+			"prefix": the nickname starts with the given text, e.g. "bo" finds Bob and bobby. Ordered by nickname
+			"fuzzy": the closest nicknames, allowing for typos, best first. At most limit distinct nicknames are considered"""
+		if match not in ("exact", "prefix", "fuzzy"):
+			raise ValueError("match must be exact, prefix or fuzzy")
+		records = self.user_indexes.records
+		with self.nicknames.lock:
+			if match == "exact":
+				userids = sorted(self.nicknames.exact(nickname))
+			elif match == "prefix":
+				userids = self.nicknames.prefix(nickname)
+			else:
+				userids = self.nicknames.fuzzy(nickname, limit)
+			# the indexes can disagree for a moment, e.g. while a login is being indexed
+			return [records[userid] for userid in userids if userid in records]
+
 	def get_users_in_channel(self, id=None):
 		"""Retrieves a list of users in the specified channel.
 		id can be anything accepted by get_channel
@@ -629,66 +1165,128 @@ class TeamTalkServer:
 		Target can be anything accepted by get_user
 		Channel can be anything accepted by get_channel"""
 		target = self.get_user(target)
-		target = target.get("userid")
-		params = {"userid": target}
+		params = {"userid": target.get("userid")}
+		ban = {"ipaddr": target.get("ipaddr", ""), "username": target.get("username", ""), "nickname": target.get("nickname", "")}
 		if channel:
 			channel = self.get_channel(channel)
-			channel = channel.get("chanid")
-			params["chanid"] = channel
-		if id:
-			params["id"] = id
+			params["chanid"] = channel.get("chanid")
+			ban["chanpath"] = channel.get("channel")
+		params["id"] = self._cache_id(id, self.ban_cache, BAN_CHANGE_ID)
 		msg = build_tt_message("ban", params)
 		self.send(msg)
+		self.ban_cache.add(ban)
 
 	def ban_by_ip(self, ip_address, channel=None, id=None):
 		params = {"ipaddr": ip_address}
+		ban = {"ipaddr": ip_address}
 		if channel:
 			channel = self.get_channel(channel)
 			params["chanid"] = channel.get("chanid")
+			ban["chanpath"] = channel.get("channel")
+		params["id"] = self._cache_id(id, self.ban_cache, BAN_CHANGE_ID)
 		msg = build_tt_message("ban", params)
 		self.send(msg)
+		self.ban_cache.add(ban)
 
 	def unban(self, target, channel=None, id=None):
 		"""Unbans the provided user from a channel (if specified) otherwise the server.
 		Target can be an ip address
 		Channel can be anything accepted by get_channel"""
 		params = {"ipaddr": target}
+		ban = {"ipaddr": target}
 		if channel:
 			channel = self.get_channel(channel)
-			channel = channel.get("chanid")
-			params["chanid"] = channel
-		if id:
-			params["id"] = id
+			params["chanid"] = channel.get("chanid")
+			ban["chanpath"] = channel.get("channel")
+		params["id"] = self._cache_id(id, self.ban_cache, BAN_CHANGE_ID)
 		msg = build_tt_message("unban", params)
 		self.send(msg)
-
-	def get_bans(self):
+		if channel:
+			self.ban_cache.discard(**ban)
+		else:
+			# bans from channels on the same address are still in place
+			self.ban_cache.discard(lambda record: not record.get("chanpath"), **ban)
+
+	def get_bans(self, refresh=False):
+		"""Retrieves a list of bans on this server.
+		The list is only downloaded when the cache is empty or stale, and is patched by ban, ban_by_ip and unban in between
+		Pass refresh=True (or call self.ban_cache.invalidate()) to download it again regardless
+		Blocks, so another thread needs to be handling messages"""
+		if not refresh and self.ban_cache.fresh:
+			return self.bans
 		msg = build_tt_message("listbans", {"id": 101})
 		self.getting_bans = True
-		self.send(msg)
-		self._sleep(0.2)
-		while self.getting_bans:
-			self._sleep(0.05)
+		with self._waiting_for_reader():
+			self.send(msg)
+			self._sleep(0.2)
+			while self.getting_bans:
+				self._sleep(0.05)
 		return self.bans
 
-	def get_accounts(self):
+	def find_bans(self, ipaddr=None, username=None):
+		"""Retrieves a list of bans matching the given ip address and/or username, without scanning
+		Downloads the ban list first if necessary, see get_bans"""
+		fields = {}
+		if ipaddr is not None:
+			fields["ipaddr"] = ipaddr
+		if username is not None:
+			fields["username"] = username
+		if not fields:
+			raise ValueError("Either ipaddr or username is required")
+		self.get_bans()
+		return self.ban_cache.lookup(**fields)
+
+	def get_accounts(self, refresh=False):
+		"""Retrieves a list of user accounts on this server.
+		The list is only downloaded when the cache is empty or stale, and is patched by new_account and delete_account in between
+		Pass refresh=True (or call self.account_cache.invalidate()) to download it again regardless
+		Blocks, so another thread needs to be handling messages"""
+		if not refresh and self.account_cache.fresh:
+			return self.accounts
 		msg = build_tt_message("listaccounts", {"index": 0, "count": 1000000, "id": 10})
 		self.getting_accounts = True
-		self.send(msg)
-		while self.getting_accounts:
-			self._sleep(0.05)
+		with self._waiting_for_reader():
+			self.send(msg)
+			while self.getting_accounts:
+				self._sleep(0.05)
 		return self.accounts
 
+	def _waiting_for_reader(self):
+		"""Returns a context manager to wrap waiting for the thread handling messages in
+		When called from a handler on the dispatcher thread, the reader mustn't in turn wait for the dispatcher to make room in the queue"""
+		queue = self.event_queue
+		if queue is not None and threading.current_thread() is self.dispatcher_thread:
+			return queue.unbounded()
+		return contextlib.nullcontext()
+
+	def get_account(self, username):
+		"""Retrieves the account with the given username, or None if there isn't one
+		Downloads the account list first if necessary, see get_accounts"""
+		self.get_accounts()
+		accounts = self.account_cache.lookup(username=username)
+		if accounts:
+			return accounts[0]
+
 	def new_account(self, username, password, usertype, userRights=[]):
 		params = {"username": username, "password": password, "usertype": usertype}
 		if usertype < 2:
 			params.update({"userrights": USERRIGHT_DEFAULT})
-		msg = build_tt_message("newaccount", params)
+		msg = build_tt_message("newaccount", dict(params, id=ACCOUNT_CHANGE_ID))
 		self.send(msg)
+		self.account_cache.discard(username=username)
+		self.account_cache.add(params)
 
 	def delete_account(self, username: str):
-		msg = build_tt_message("delaccount", {"username": username})
+		msg = build_tt_message("delaccount", {"username": username, "id": ACCOUNT_CHANGE_ID})
 		self.send(msg)
+		self.account_cache.discard(username=username)
+
+	def _cache_id(self, id, cache, default):
+		"""Returns the id to send a command that changes cache with, remembering which cache a failure of it concerns"""
+		if not id:
+			return default
+		self._cache_ids[id] = cache
+		return id
 
 	def move(self, user, destination, id=None):
 		"""Moves the provided user to destination.
@@ -852,9 +1450,9 @@ class TeamTalkServer:
 		if self.current_id == 1:
 			self.logging_in = True
 		if self.current_id == 10 and self.getting_accounts:
-			self.accounts.clear()
+			self.account_cache.clear()
 		if self.current_id == 101 and self.getting_bans:
-			self.bans.clear()
+			self.ban_cache.clear()
 
 	@staticmethod
 	def _handle_end(self, params):
@@ -872,8 +1470,10 @@ class TeamTalkServer:
 			self.logging_in = False
 			self._login_sequence = 2
 		if params["id"] == 10 and self.getting_accounts:
+			self.account_cache.filled()
 			self.getting_accounts = False
 		if params["id"] == 101 and self.getting_bans:
+			self.ban_cache.filled()
 			self.getting_bans = False
 
 	@staticmethod
@@ -881,12 +1481,20 @@ class TeamTalkServer:
 		"""Event fired when a user has just logged in.
 		Is also sent during login for every currently logged in user"""
 		user_index = self.get_user(params["userid"], index=True)
-		if not user_index:
+		if user_index is None:
 			self.users.append(params)
+			self.user_indexes.add(params["userid"], params)
+			self.nicknames.add(params["userid"], params.get("nickname"))
+			self._publish_user(params["userid"])
 		else:
 			# something was updated
 			# I don't think this should happen, but just to be sure
 			self.users[user_index].update(params)
+			self.user_indexes.reindex(params["userid"])
+			self.nicknames.add(params["userid"], self.users[user_index].get("nickname"))
+			self._publish_user(params["userid"])
+		if self.sublocal is not None:
+			self._queue_subscriptions((params["userid"],))
 
 	@staticmethod
 	def _handle_loggedout(self, params):
@@ -898,6 +1506,9 @@ class TeamTalkServer:
 			user = self.get_user(params["userid"])
 			if user:
 				self.users.remove(user)
+			self.user_indexes.remove(params["userid"])
+			self.nicknames.remove(params["userid"])
+			self._publish_user(params["userid"])
 
 	@staticmethod
 	def _handle_accepted(self, params):
@@ -905,30 +1516,34 @@ class TeamTalkServer:
 		Contains information about the current user"""
 		self.me.update(params)
 		self.logged_out = False
+		self._publish(me=freeze(self.me))
 
 	@staticmethod
 	def _handle_serverupdate(self, params):
 		"""Event fired after login that exposes more info to a client
 		May also mean that attributes of this server have changed"""
 		self.server_params.update(params)
+		self._publish(server_params=freeze(self.server_params))
 
 	@staticmethod
 	def _handle_addchannel(self, params):
 		"""Event fired when a new channel has been created
 		Can also be used to tell a newly connected user about a channel"""
 		chan_index = self.get_channel(params["chanid"], index=True)
-		if not chan_index:
+		if chan_index is None:
 			self.channels.append(params)
 		else:
 			# shouldn't happen
 			self.channels[chan_index].update(params)
+		self._publish_channel(params["chanid"])
 
 	@staticmethod
 	def _handle_updatechannel(self, params):
 		"""Event fired when an attribute of a channel has changed"""
 		chan_index = self.get_channel(params["chanid"], index=True)
-		if chan_index:
+		if chan_index is not None:
 			self.channels[chan_index].update(params)
+			self._publish_channel(params["chanid"])
 
 	@staticmethod
 	def _handle_removechannel(self, params):
@@ -936,16 +1551,19 @@ class TeamTalkServer:
 		channel = self.get_channel(params["chanid"])
 		if channel:
 			self.channels.remove(channel)
+			self._publish_channel(params["chanid"])
 
 	@staticmethod
 	def _handle_joined(self, params):
 		"""Event fired when this user joins a channel"""
 		self.me.update(params)
+		self._publish(me=freeze(self.me))
 
 	@staticmethod
 	def _handle_left(self, params):
 		"""Event fired when this user leaves a channel"""
 		del self.me["chanid"]
+		self._publish(me=freeze(self.me))
 
 	@staticmethod
 	def _handle_adduser(self, params):
@@ -954,6 +1572,8 @@ class TeamTalkServer:
 		user_index = self.get_user(params["userid"], index=True)
 		if user_index != None:
 			self.users[user_index].update(params)
+			self.user_indexes.reindex(params["userid"])
+			self._publish_user(params["userid"])
 
 	@staticmethod
 	def _handle_removeuser(self, params):
@@ -961,6 +1581,8 @@ class TeamTalkServer:
 		user_index = self.get_user(params["userid"], index=True)
 		if user_index != None:
 			del self.users[user_index]["chanid"]
+			self.user_indexes.reindex(params["userid"])
+			self._publish_user(params["userid"])
 
 	@staticmethod
 	def _handle_updateuser(self, params):
@@ -968,6 +1590,10 @@ class TeamTalkServer:
 		user_index = self.get_user(params["userid"], index=True)
 		if user_index != None:
 			self.users[user_index].update(params)
+			self.user_indexes.reindex(params["userid"])
+			if "nickname" in params:
+				self.nicknames.add(params["userid"], params["nickname"])
+			self._publish_user(params["userid"])
 
 	@staticmethod
 	def _handle_addfile(self, params):
@@ -985,9 +1611,10 @@ class TeamTalkServer:
 	@staticmethod
 	def _handle_useraccount(self, params):
 		"""Event fired with account information after a call to list the accounts on the server."""
-		self.accounts.append(params)
+		self.account_cache.discard(username=params.get("username"))
+		self.account_cache.add(params)
 
 	@staticmethod
 	def _handle_userbanned(self, params):
 		"""Event fired with ban information after a call to list the bans on the server."""
-		self.bans.append(params)
+		self.ban_cache.add(params)
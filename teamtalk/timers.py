@@ -0,0 +1,86 @@
+"""Scheduling of timed callbacks, run from a server's message loop."""
+
+# A part of PyTeamTalk
+# author: Carter Temm
+# License: MIT
+
+import heapq
+import itertools
+import threading
+import time
+
+
+class Timer:
+	"""A scheduled call, as returned by TeamTalkServer.call_later, call_every and call_at"""
+
+	__slots__ = ("when", "interval", "func", "args", "cancelled")
+
+	def __init__(self, when, interval, func, args):
+		# time.monotonic() based
+		self.when = when
+		self.interval = interval
+		self.func = func
+		self.args = args
+		self.cancelled = False
+
+	def cancel(self):
+		"""Prevents this timer from running again. Safe to call from any thread"""
+		self.cancelled = True
+
+	def __repr__(self):
+		state = "cancelled" if self.cancelled else f"due in {self.when - time.monotonic():.3f}s"
+		return f"<Timer {getattr(self.func, '__name__', self.func)} {state}>"
+
+
+class Scheduler:
+	"""A heap of timers, ordered by when they are due."""
+
+	def __init__(self):
+		self._heap = []
+		# breaks ties so timers never need to be compared
+		self._counter = itertools.count()
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._heap)
+
+	def schedule(self, when, func, args=(), interval=None):
+		"""Schedules func(*args) for when (in time.monotonic() terms), repeating every interval seconds if given.
+		Returns a tuple of (timer, earliest), where earliest is True if the new timer is now the next one due"""
+		timer = Timer(when, interval, func, args)
+		with self._lock:
+			heapq.heappush(self._heap, (when, next(self._counter), timer))
+			return timer, self._heap[0][2] is timer
+
+	def next_delay(self):
+		"""Returns seconds until the next timer is due, or None if there are none"""
+		with self._lock:
+			while self._heap and self._heap[0][2].cancelled:
+				heapq.heappop(self._heap)
+			if not self._heap:
+				return None
+			return max(self._heap[0][0] - time.monotonic(), 0)
+
+	def run_due(self, call=None):
+		"""Runs every timer that is due, then returns seconds until the next one (see next_delay)
+		If given, call(func, args) is used to run each timer rather than calling it directly"""
+		now = time.monotonic()
+		while True:
+			with self._lock:
+				if not self._heap or self._heap[0][0] > now:
+					break
+				timer = heapq.heappop(self._heap)[2]
+				if timer.cancelled:
+					continue
+				if timer.interval:
+					# keep to the original schedule rather than drifting, skipping runs we were too late for
+					missed = (now - timer.when) // timer.interval
+					timer.when += timer.interval * (missed + 1)
+					heapq.heappush(self._heap, (timer.when, next(self._counter), timer))
+				else:
+					timer.cancelled = True
+			if call is None:
+				timer.func(*timer.args)
+			else:
+				call(timer.func, timer.args)
+		return self.next_delay()
@@ -0,0 +1,358 @@
+"""Compact history of how many users are online, for capacity planning.
+
+PopulationRecorder samples the number of users on a server and in each of its channels at a fixed interval, storing the samples in typed arrays rather than lists of dicts. Older samples are rolled up into coarser tiers (by default 10 seconds for a day, 5 minutes for four weeks and hourly for a year), so memory use stays fixed however long it runs.
+Recordings can be written to a file that TimeSeriesFile memory maps, letting dashboards read them without parsing or copying."""
+
+# A part of PyTeamTalk
+# author: Carter Temm
+# License: MIT
+
+import array
+import bisect
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+from teamtalk.stats import percentile
+
+
+DEFAULT_TIERS = ((10, 8640), (300, 8064), (3600, 8760))
+
+# start is a time.time() timestamp, the others are the lowest, highest and average value seen over the point's interval
+COLUMNS = (("start", "d"), ("min", "f"), ("max", "f"), ("mean", "f"))
+
+_EVENTS = ("loggedin", "loggedout", "adduser", "removeuser", "addchannel", "removechannel", "serverupdate")
+
+_magic = b"TTSERIES"
+_header = struct.Struct("<8sI")
+
+
+class Tier:
+	"""The points of a series at a single resolution, step seconds apart, keeping the most recent capacity of them
+	Columns are arrays that grow until full, then wrap around"""
+
+	def __init__(self, step, capacity):
+		self.step = step
+		self.capacity = capacity
+		self.columns = {name: array.array(typecode) for name, typecode in COLUMNS}
+		# index of the oldest point once full
+		self.head = 0
+		# the point being built from finer samples: [start, min, max, sum, count]
+		self.pending = None
+
+	def __len__(self):
+		return len(self.columns["start"])
+
+	def append(self, start, low, high, mean):
+		values = (start, low, high, mean)
+		if len(self) < self.capacity:
+			for (name, typecode), value in zip(COLUMNS, values):
+				self.columns[name].append(value)
+		else:
+			for (name, typecode), value in zip(COLUMNS, values):
+				self.columns[name][self.head] = value
+			self.head = (self.head + 1) % self.capacity
+
+	def accumulate(self, start, low, high, mean):
+		"""Adds a finer point to the one being built, returning the previous point if this one starts a new interval"""
+		bucket = start - start % self.step
+		finished = None
+		pending = self.pending
+		if pending is not None and pending[0] != bucket:
+			finished = (pending[0], pending[1], pending[2], pending[3] / pending[4])
+			self.append(*finished)
+			pending = None
+		if pending is None:
+			self.pending = [bucket, low, high, mean, 1]
+		else:
+			pending[1] = min(pending[1], low)
+			pending[2] = max(pending[2], high)
+			pending[3] += mean
+			pending[4] += 1
+		return finished
+
+	def ordered(self):
+		"""Returns the columns oldest point first"""
+		if not self.head:
+			return self.columns
+		return {name: column[self.head:] + column[:self.head] for name, column in self.columns.items()}
+
+
+class Series:
+	"""A single measurement (e.g. users in a channel) kept at several resolutions, finest first"""
+
+	def __init__(self, tiers=DEFAULT_TIERS):
+		self.tiers = [Tier(step, capacity) for step, capacity in tiers]
+
+	def add(self, start, low, high, mean):
+		self.tiers[0].append(start, low, high, mean)
+		point = (start, low, high, mean)
+		for tier in self.tiers[1:]:
+			point = tier.accumulate(*point)
+			if point is None:
+				break
+
+
+def aggregate(tiers, start=None, end=None, interval=None, percentiles=(50, 90, 99)):
+	"""Summarizes the points between start and end (time.time() timestamps, defaulting to everything) in intervals of interval seconds (one interval if None)
+	tiers is a list of (step, columns) ordered finest first, columns being as returned by Tier.ordered. The finest tier reaching back to start is used. If start is None or none reach back that far, the one reaching furthest back is, which may not have the last of its coarser points yet
+	Returns a list of dicts with the keys start, count, min, max, mean and the requested percentiles of the means (p50 and so on), skipping intervals without any points"""
+	chosen = None
+	for step, columns in tiers:
+		first = columns["start"]
+		if not len(first):
+			continue
+		if start is not None and first[0] <= start:
+			chosen = columns
+			break
+		if chosen is None or first[0] < chosen["start"][0]:
+			chosen = columns
+	if chosen is None:
+		return []
+	starts = chosen["start"]
+	if start is None:
+		start = starts[0]
+	if end is None:
+		end = starts[-1] + 1
+	if interval is None:
+		interval = end - start
+	results = []
+	low = bisect.bisect_left(starts, start)
+	bucket = start
+	while bucket < end and low < len(starts):
+		high = bisect.bisect_left(starts, min(bucket + interval, end), low)
+		if high > low:
+			# slicing arrays and reducing with the builtins all happens in C
+			means = chosen["mean"][low:high]
+			result = {
+				"start": bucket,
+				"count": high - low,
+				"min": min(chosen["min"][low:high]),
+				"max": max(chosen["max"][low:high]),
+				"mean": sum(means) / len(means),
+			}
+			ordered = sorted(means)
+			for p in percentiles:
+				result[f"p{p:g}"] = percentile(ordered, p)
+			results.append(result)
+		low = high
+		bucket += interval
+	return results
+
+
+class PopulationRecorder:
+	"""Records the population of a server every resolution seconds, see attach
+	Series are named "users" (everyone online), "maxusers" (the server's limit), "channels" (how many channels exist) and "channel:<path>" for the users in each channel. Each sample holds the lowest and highest count seen since the last one, as well as the count at the time
+	tiers is a list of (step in seconds, number of points to keep), finest first. The first step is the sampling resolution"""
+
+	def __init__(self, tiers=DEFAULT_TIERS):
+		self.tier_spec = tuple(tiers)
+		self.resolution = self.tier_spec[0][0]
+		self.series = {}
+		self.lock = threading.Lock()
+		self.server = None
+		self._timer = None
+		# userid -> chanid, and the current and extreme counts since the last sample: name -> [count, low, high]
+		self._locations = {}
+		self._counts = {}
+
+	def attach(self, server):
+		"""Starts recording server's population. Samples are taken by a timer, so handle_messages needs to be running"""
+		if self.server is not None:
+			raise ValueError("Already attached to a server")
+		self.server = server
+		with self.lock:
+			self._locations = {user["userid"]: user.get("chanid") for user in server.users}
+			self._counts = {"users": [len(server.users)] * 3, "channels": [len(server.channels)] * 3}
+			if "maxusers" in server.server_params:
+				self._counts["maxusers"] = [int(server.server_params["maxusers"])] * 3
+			for chanid in self._locations.values():
+				if chanid is not None:
+					self._change(self._channel_key(chanid), 1)
+		for event in _EVENTS:
+			server.subscribe(event, getattr(self, "_handle_" + event))
+		self._timer = server.call_every(self.resolution, self.sample)
+
+	def detach(self):
+		"""Stops recording. Samples already taken are kept"""
+		self._timer.cancel()
+		for event in _EVENTS:
+			self.server.unsubscribe(event, getattr(self, "_handle_" + event))
+		self.server = None
+
+	def sample(self, now=None):
+		"""Records a point for every series. Called automatically every resolution seconds"""
+		now = time.time() if now is None else now
+		with self.lock:
+			existing = None
+			for name, counts in list(self._counts.items()):
+				count, low, high = counts
+				series = self.series.get(name)
+				if series is None:
+					series = self.series[name] = Series(self.tier_spec)
+				series.add(now, low, high, count)
+				counts[1] = counts[2] = count
+				if not count and name.startswith("channel:"):
+					if existing is None:
+						existing = self._channel_names()
+					if name not in existing:
+						# the channel is gone, stop recording it once its last point is in
+						del self._counts[name]
+
+	def keys(self):
+		with self.lock:
+			return sorted(self.series)
+
+	def aggregate(self, name, start=None, end=None, interval=None, percentiles=(50, 90, 99)):
+		"""Summarizes a series over time, see teamtalk.timeseries.aggregate
+		e.g. aggregate("users", time.time() - 86400, interval=3600) gives hourly figures for the last day"""
+		with self.lock:
+			series = self.series.get(name)
+			if series is None:
+				raise KeyError(name)
+			tiers = [(tier.step, tier.ordered()) for tier in series.tiers]
+		return aggregate(tiers, start, end, interval, percentiles)
+
+	def dump(self, path):
+		"""Writes every series to path, in the format read by TimeSeriesFile
+		The file is replaced in one step, so readers never see a partial write"""
+		with self.lock:
+			tiers = {name: [(tier.step, tier.ordered()) for tier in series.tiers] for name, series in self.series.items()}
+		index = {}
+		blobs = []
+		offset = 0
+		for name, name_tiers in tiers.items():
+			index[name] = []
+			for step, columns in name_tiers:
+				entry = {"step": step, "length": len(columns["start"]), "columns": {}}
+				for column, typecode in COLUMNS:
+					data = columns[column].tobytes()
+					# keep columns 8 byte aligned so they can be cast in place
+					padding = -len(data) % 8
+					entry["columns"][column] = offset
+					blobs.append(data + b"\0" * padding)
+					offset += len(data) + padding
+				index[name].append(entry)
+		header = json.dumps({"columns": COLUMNS, "series": index}).encode()
+		header += b" " * (-(len(header) + _header.size) % 8)
+		temp = path + ".tmp"
+		with open(temp, "wb") as f:
+			f.write(_header.pack(_magic, len(header)))
+			f.write(header)
+			for blob in blobs:
+				f.write(blob)
+		os.replace(temp, path)
+
+	def _channel_key(self, chanid):
+		channel = self.server.get_channel(chanid) if self.server else None
+		return "channel:" + (channel.get("channel", str(chanid)) if channel else str(chanid))
+
+	def _channel_names(self):
+		return {"channel:" + channel.get("channel", str(channel["chanid"])) for channel in self.server.channels} if self.server else set()
+
+	def _change(self, name, amount):
+		counts = self._counts.get(name)
+		if counts is None:
+			counts = self._counts[name] = [0, 0, 0]
+		counts[0] += amount
+		counts[1] = min(counts[1], counts[0])
+		counts[2] = max(counts[2], counts[0])
+
+	def _move(self, userid, chanid):
+		previous = self._locations.get(userid)
+		if previous == chanid:
+			return
+		if previous is not None:
+			self._change(self._channel_key(previous), -1)
+		if chanid is not None:
+			self._change(self._channel_key(chanid), 1)
+		self._locations[userid] = chanid
+
+	def _handle_loggedin(self, server, params):
+		with self.lock:
+			if params["userid"] not in self._locations:
+				self._locations[params["userid"]] = None
+				self._change("users", 1)
+
+	def _handle_loggedout(self, server, params):
+		with self.lock:
+			if params.get("userid") in self._locations:
+				self._move(params["userid"], None)
+				del self._locations[params["userid"]]
+				self._change("users", -1)
+
+	def _handle_adduser(self, server, params):
+		with self.lock:
+			self._move(params["userid"], params.get("chanid"))
+
+	def _handle_removeuser(self, server, params):
+		with self.lock:
+			self._move(params["userid"], None)
+
+	def _handle_addchannel(self, server, params):
+		with self.lock:
+			self._change("channels", 1)
+
+	def _handle_removechannel(self, server, params):
+		with self.lock:
+			self._change("channels", -1)
+
+	def _handle_serverupdate(self, server, params):
+		if "maxusers" not in params:
+			return
+		with self.lock:
+			counts = self._counts.get("maxusers")
+			self._change("maxusers", int(params["maxusers"]) - (counts[0] if counts else 0))
+
+
+class TimeSeriesFile:
+	"""Read-only access to a file written by PopulationRecorder.dump, without loading it into memory
+	Columns are memoryviews straight onto the mapped file. Call close, or use as a context manager, when finished"""
+
+	def __init__(self, path):
+		with open(path, "rb") as f:
+			self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, length = _header.unpack_from(self._mmap)
+		if magic != _magic:
+			self._mmap.close()
+			raise ValueError(path + " is not a time series file")
+		base = _header.size + length
+		metadata = json.loads(bytes(self._mmap[_header.size:base]))
+		view = memoryview(self._mmap)
+		sizes = {typecode: struct.calcsize(typecode) for name, typecode in COLUMNS}
+		self._views = []
+		self.series = {}
+		for name, entries in metadata["series"].items():
+			tiers = []
+			for entry in entries:
+				columns = {}
+				for column, typecode in COLUMNS:
+					offset = base + entry["columns"][column]
+					columns[column] = view[offset:offset + entry["length"] * sizes[typecode]].cast(typecode)
+					self._views.append(columns[column])
+				tiers.append((entry["step"], columns))
+			self.series[name] = tiers
+		self._views.append(view)
+
+	def keys(self):
+		return sorted(self.series)
+
+	def aggregate(self, name, start=None, end=None, interval=None, percentiles=(50, 90, 99)):
+		"""See PopulationRecorder.aggregate"""
+		return aggregate(self.series[name], start, end, interval, percentiles)
+
+	def close(self):
+		for view in self._views:
+			view.release()
+		self._views.clear()
+		self.series.clear()
+		self._mmap.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
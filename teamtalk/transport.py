@@ -0,0 +1,388 @@
+"""Line oriented socket transport used for both plain and encrypted connections.
+
+Replaces telnetlib, which does telnet option processing the TeamTalk protocol has no use for and is no longer part of the standard library."""
+
+# A part of PyTeamTalk
+# author: Carter Temm
+# License: MIT
+
+import errno
+import os
+import selectors
+import socket
+import ssl
+import threading
+import time
+
+
+class Transport:
+	"""A buffered connection to a server that reads and writes whole lines.
+	The underlying socket is kept in non-blocking mode once connected. Reads wait using a selector, so read_line(timeout=0) polls without ever blocking, and fileno() can be handed to an external event loop
+	Options:
+		nodelay: disable Nagle's algorithm, so short commands aren't held back waiting for more data (default True)
+		keepalive: enable TCP keepalives. May also be a number of idle seconds before the first probe is sent, where supported
+		rcvbuf, sndbuf: kernel buffer sizes in bytes, left at the system defaults if None
+		read_size: the most bytes to read at once
+	"""
+
+	def __init__(self, sock, nodelay=True, keepalive=False, rcvbuf=None, sndbuf=None, read_size=65536):
+		self.sock = sock
+		self.read_size = read_size
+		self.closed = False
+		self._buffer = bytearray()
+		self._eof = False
+		self._write_lock = threading.Lock()
+		self._selector = None
+		# guards closing against threads in read_line
+		self._state_lock = threading.Lock()
+		self._readers = 0
+		# written to by wakeup to interrupt a reader waiting on the selector
+		self._waker = socket.socketpair()
+		for i in self._waker:
+			i.setblocking(False)
+		# seconds spent on each phase of connecting, see connect
+		self.timings = {}
+		configure_socket(sock, nodelay, keepalive, rcvbuf, sndbuf)
+
+	@classmethod
+	def connect(cls, address, timeout=None, resolver=None, stagger=0.25, **options):
+		"""Opens a TCP connection to address, a (host, port) tuple, applying options before connecting.
+		timeout bounds the whole attempt, looking up host included. Addresses are tried happy eyeballs style (RFC 8305): IPv6 and IPv4 alternate, and if one hasn't connected within stagger seconds the next is started alongside it, the first to connect winning
+		Lookups go through resolver, default_resolver if None. The time each phase took is left in the transport's timings dict ("dns" and "tcp")
+		Raises OSError on failure, TimeoutError in particular if time runs out"""
+		host, port = address
+		deadline = None if timeout is None else time.monotonic() + timeout
+		started = time.perf_counter()
+		addresses = (resolver or default_resolver).resolve(host, port, timeout)
+		resolved = time.perf_counter()
+		sock = _race(addresses, deadline, stagger, options.get("rcvbuf"), options.get("sndbuf"))
+		transport = cls(sock, **options)
+		transport.timings["dns"] = resolved - started
+		transport.timings["tcp"] = time.perf_counter() - resolved
+		transport._start()
+		return transport
+
+	def start_tls(self, context, server_hostname=None, session=None, timeout=None):
+		"""Performs a TLS handshake over this connection, encrypting everything from then on.
+		session, if given, is an ssl.SSLSession from a previous connection to resume"""
+		self._stop()
+		self.sock.settimeout(timeout)
+		try:
+			self.sock = context.wrap_socket(self.sock, server_hostname=server_hostname, session=session)
+		except BaseException:
+			self.close()
+			raise
+		self._start()
+
+	@property
+	def session(self):
+		"""The TLS session in use, or None for plain connections"""
+		return getattr(self.sock, "session", None)
+
+	@property
+	def session_reused(self):
+		return getattr(self.sock, "session_reused", False)
+
+	def fileno(self):
+		return self.sock.fileno()
+
+	def read_line(self, timeout=None):
+		"""Returns the next line received, including its terminator.
+		If a complete line doesn't arrive within timeout seconds, returns b"" and keeps whatever was received for next time. If timeout is None, waits indefinitely
+		Raises EOFError once the server has closed the connection and every line has been read"""
+		deadline = None if timeout is None else time.monotonic() + timeout
+		with self._state_lock:
+			if self.closed:
+				return b""
+			self._readers += 1
+		try:
+			return self._read_line(deadline)
+		finally:
+			with self._state_lock:
+				self._readers -= 1
+				if self.closed and not self._readers:
+					self._release()
+
+	def _read_line(self, deadline):
+		while True:
+			index = self._buffer.find(b"\n")
+			if index >= 0:
+				line = bytes(self._buffer[:index + 1])
+				del self._buffer[:index + 1]
+				return line
+			if self._eof:
+				if self._buffer:
+					# the server hung up mid line, hand over what we have
+					line = bytes(self._buffer)
+					self._buffer.clear()
+					return line
+				raise EOFError("Connection closed by server")
+			if self.closed or not self._fill(deadline):
+				return b""
+
+	def write(self, data):
+		"""Sends all of data, waiting for room in the socket's buffer if necessary"""
+		view = memoryview(data)
+		with self._write_lock:
+			while view:
+				try:
+					sent = self.sock.send(view)
+				except (BlockingIOError, ssl.SSLWantWriteError, ssl.SSLWantReadError):
+					# the reader owns self._selector, so wait on a separate one
+					with selectors.DefaultSelector() as selector:
+						selector.register(self.sock, selectors.EVENT_WRITE)
+						selector.select()
+					continue
+				view = view[sent:]
+
+	def wakeup(self):
+		"""Makes a thread waiting in read_line return b"" early. Safe to call from any thread"""
+		try:
+			self._waker[1].send(b"\0")
+		except OSError:
+			# either closed, or a wakeup is already pending
+			pass
+
+	def close(self):
+		"""Closes the connection, waking any thread waiting in read_line"""
+		with self._state_lock:
+			if self.closed:
+				return
+			self.closed = True
+			try:
+				self.sock.shutdown(socket.SHUT_RDWR)
+			except OSError:
+				pass
+			# closing the socket while a reader is waiting on it can leave the reader waiting forever, so readers clean up after themselves
+			if self._readers:
+				self.wakeup()
+			else:
+				self._release()
+
+	def _release(self):
+		if self._selector:
+			self._selector.close()
+			self._selector = None
+		self.sock.close()
+		for i in self._waker:
+			i.close()
+
+	def _start(self):
+		self.sock.setblocking(False)
+		self._selector = selectors.DefaultSelector()
+		self._selector.register(self.sock, selectors.EVENT_READ)
+		self._selector.register(self._waker[0], selectors.EVENT_READ, "wakeup")
+
+	def _stop(self):
+		if self._selector:
+			self._selector.close()
+			self._selector = None
+		self.sock.setblocking(True)
+
+	def _fill(self, deadline):
+		"""Reads whatever is available into the buffer, waiting until deadline at most.
+		Returns False if the wait timed out"""
+		# encrypted sockets may already hold decrypted data the selector doesn't know about
+		pending = getattr(self.sock, "pending", None)
+		if not (pending and pending()):
+			timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+			if not self._wait(timeout) or self.closed:
+				return False
+		try:
+			data = self.sock.recv(self.read_size)
+		except (BlockingIOError, InterruptedError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+			# readable, but only for TLS housekeeping such as session tickets
+			return True
+		except OSError:
+			if self.closed:
+				return False
+			raise
+		if not data:
+			self._eof = True
+			return True
+		self._buffer += data
+		return True
+
+	def _wait(self, timeout):
+		"""Waits for the socket to become readable
+		Returns False on timeout or wakeup"""
+		selector = self._selector
+		if selector is None:
+			return False
+		try:
+			events = selector.select(timeout)
+		except (OSError, ValueError):
+			# closed from another thread
+			return False
+		readable = False
+		for key, mask in events:
+			if key.data == "wakeup":
+				try:
+					while self._waker[0].recv(64):
+						pass
+				except OSError:
+					pass
+			else:
+				readable = True
+		return readable
+
+
+def configure_socket(sock, nodelay=None, keepalive=None, rcvbuf=None, sndbuf=None):
+	"""Applies TCP options to sock. Options that are None are left alone"""
+	if nodelay is not None:
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(bool(nodelay)))
+	if keepalive is not None:
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, int(bool(keepalive)))
+		if keepalive is not True and keepalive and hasattr(socket, "TCP_KEEPIDLE"):
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, int(keepalive))
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(int(keepalive) // 3, 1))
+	if rcvbuf:
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+	if sndbuf:
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+
+
+class Resolver:
+	"""Looks up addresses with getaddrinfo, remembering them for ttl seconds and failures for negative_ttl
+	The system resolver doesn't say how long records may be cached for, so both are fixed. Lookups of the same host made at the same time share a single query"""
+
+	def __init__(self, ttl=300, negative_ttl=30, maxsize=1024):
+		self.ttl = ttl
+		self.negative_ttl = negative_ttl
+		self.maxsize = maxsize
+		self.lock = threading.Lock()
+		# (host, port) -> (expires, addresses, error)
+		self._cache = {}
+		self._lookups = {}
+
+	def resolve(self, host, port, timeout=None):
+		"""Returns a list of getaddrinfo style (family, type, proto, canonname, sockaddr) tuples for TCP connections to host
+		Raises socket.gaierror if the lookup fails, or TimeoutError if it takes longer than timeout seconds"""
+		key = (host, port)
+		with self.lock:
+			entry = self._cache.get(key)
+			if entry is None or time.monotonic() >= entry[0]:
+				entry = None
+				lookup = self._lookups.get(key)
+				if lookup is None:
+					lookup = self._lookups[key] = threading.Event()
+					# in a thread of its own so it can be given up on, the result is still cached once it arrives
+					threading.Thread(target=self._lookup, args=(key,), daemon=True).start()
+		if entry is None:
+			if not lookup.wait(timeout):
+				raise TimeoutError(f"Looking up {host} took longer than {timeout} seconds")
+			with self.lock:
+				entry = self._cache[key]
+		if entry[2] is not None:
+			raise entry[2]
+		return entry[1]
+
+	def clear(self):
+		with self.lock:
+			self._cache.clear()
+
+	def _lookup(self, key):
+		addresses = error = None
+		try:
+			addresses = socket.getaddrinfo(key[0], key[1], type=socket.SOCK_STREAM)
+			if not addresses:
+				error = socket.gaierror("getaddrinfo returned no addresses for " + str(key[0]))
+		except OSError as exc:
+			error = exc
+		now = time.monotonic()
+		with self.lock:
+			if len(self._cache) >= self.maxsize:
+				for k in [k for k, v in self._cache.items() if v[0] <= now] or list(self._cache)[:len(self._cache) // 2]:
+					del self._cache[k]
+			self._cache[key] = (now + (self.negative_ttl if error else self.ttl), addresses, error)
+			self._lookups.pop(key).set()
+
+
+default_resolver = Resolver()
+
+# connect_ex results meaning the attempt is under way (the last being Windows' WSAEWOULDBLOCK)
+_in_progress = {errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, 10035}
+
+
+def _interleave(addresses):
+	"""Orders addresses so families alternate, starting with whichever the resolver preferred"""
+	families = {}
+	for address in addresses:
+		families.setdefault(address[0], []).append(address)
+	groups = list(families.values())
+	ordered = []
+	for i in range(max(len(group) for group in groups)):
+		ordered.extend(group[i] for group in groups if i < len(group))
+	return ordered
+
+
+def _race(addresses, deadline, stagger, rcvbuf=None, sndbuf=None):
+	"""Connects to the first of addresses to answer, starting a new attempt every stagger seconds or as soon as one fails
+	Returns the connected socket, with every other attempt closed"""
+	queue = _interleave(addresses)
+	attempts = []
+	error = None
+	winner = None
+	next_start = time.monotonic()
+	selector = selectors.DefaultSelector()
+	try:
+		while queue or attempts:
+			now = time.monotonic()
+			if deadline is not None and now >= deadline:
+				raise TimeoutError("Timed out connecting to " + ", ".join(str(i[4][0]) for i in addresses))
+			if queue and (not attempts or now >= next_start):
+				family, type, proto, canonname, sockaddr = queue.pop(0)
+				try:
+					sock = socket.socket(family, type, proto)
+				except OSError as exc:
+					error = exc
+					continue
+				try:
+					# buffer sizes need to be in place before connecting for the window size to take them into account
+					configure_socket(sock, rcvbuf=rcvbuf, sndbuf=sndbuf)
+					sock.setblocking(False)
+					result = sock.connect_ex(sockaddr)
+				except OSError as exc:
+					sock.close()
+					error = exc
+					continue
+				if result == 0:
+					winner = sock
+					break
+				if result not in _in_progress:
+					sock.close()
+					error = OSError(result, os.strerror(result))
+					continue
+				attempts.append(sock)
+				selector.register(sock, selectors.EVENT_WRITE)
+				next_start = now + stagger
+				continue
+			wait = None
+			if queue:
+				wait = max(next_start - now, 0)
+			if deadline is not None:
+				wait = deadline - now if wait is None else min(wait, deadline - now)
+			for key, mask in selector.select(wait):
+				sock = key.fileobj
+				selector.unregister(sock)
+				attempts.remove(sock)
+				result = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+				if result == 0:
+					winner = sock
+					break
+				sock.close()
+				error = OSError(result, os.strerror(result))
+				# don't wait out the stagger on a failure
+				next_start = time.monotonic()
+			if winner:
+				break
+		if winner is None:
+			raise error or OSError("No addresses to connect to")
+		winner.setblocking(True)
+		return winner
+	finally:
+		selector.close()
+		for sock in attempts:
+			if sock is not winner:
+				sock.close()
+
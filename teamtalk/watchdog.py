@@ -0,0 +1,159 @@
+"""Detection of handlers that hold up a server connection.
+
+While a subscribed function, a handle_messages callback or a timer is running, nothing else is read from the server. One that blocks for long enough gets the connection dropped, usually without any clue as to why.
+A Watchdog notices calls running longer than a threshold while they're still stuck, and reports what they were doing at the time. It also notices when handle_messages itself stops making progress, or isn't running at all."""
+
+# A part of PyTeamTalk
+# author: Carter Temm
+# License: MIT
+
+import sys
+import threading
+import time
+import traceback
+
+
+def print_report(report):
+	"""The default way stalls are reported"""
+	server = report["server"]
+	where = f"{server.host}:{server.tcpport}"
+	if report["kind"] == "no reader":
+		print(f"watchdog: nothing has read from {where} for {report['duration']:.1f}s, is handle_messages running?")
+		return
+	if report["kind"] == "reader":
+		print(f"watchdog: handle_messages on {where} has made no progress for {report['duration']:.1f}s, in thread {report['thread']}")
+	else:
+		print(f"watchdog: {report['handler']} ({report['event'] or 'idle'}) on {where} has been running for {report['duration']:.1f}s, in thread {report['thread']}")
+	print(report["stack"], end="")
+
+
+class Watchdog:
+	"""Watches the handlers, callbacks and timers run by any number of servers, and their handle_messages loops, see attach
+	Once something has been stuck for threshold seconds, report is called with a dict describing it:
+		server: the TeamTalkServer
+		kind: "call" for a handler, callback or timer, "reader" for handle_messages stuck elsewhere (sending, or waiting for room in a full teamtalk.EventQueue, for instance), or "no reader" when we're logged in but handle_messages isn't running
+		handler: the qualified name of the function ("handle_messages" for the last two)
+		event: the event being handled, "timer" for timers or "" when a callback is run for lack of traffic
+		duration: seconds it had been stuck for
+		thread: the name of the thread it's running in ("" for "no reader")
+		stack: that thread's stack at the time, formatted like a traceback ("" for "no reader")
+	report defaults to printing. It's called from the watchdog's own thread, once per stall
+	Calls are checked every interval seconds (a quarter of threshold if None), so they're reported up to that much late. Keeping track costs around a microsecond per call
+	metrics counts stalls and holds the longest stall seen (in seconds) once it has finished"""
+
+	def __init__(self, threshold=1.0, report=None, interval=None):
+		self.threshold = threshold
+		self.interval = interval or threshold / 4
+		self.report = report or print_report
+		self.metrics = {"stalls": 0, "longest": 0.0}
+		self.servers = []
+		# thread ident -> stack of [server, func, event, started, reported], innermost last
+		self._active = {}
+		# server -> the heartbeat of the reader stall last reported
+		self._stale = {}
+		self._stop = threading.Event()
+		self._thread = None
+		# captured at most once per check
+		self._frames = None
+		self._threads = None
+
+	def attach(self, server):
+		"""Starts watching server"""
+		server.watchdog = self
+		self.servers.append(server)
+		if self._thread is None:
+			# a new one each time, as a thread stopped from within may not have exited yet
+			self._stop = threading.Event()
+			self._thread = threading.Thread(target=self._run, args=(self._stop,), daemon=True, name="watchdog")
+			self._thread.start()
+
+	def detach(self, server):
+		"""Stops watching server, stopping the watchdog's thread once no servers are left"""
+		server.watchdog = None
+		self.servers.remove(server)
+		self._stale.pop(server, None)
+		if not self.servers and self._thread is not None:
+			self._stop.set()
+			# report may be detaching from our own thread, which then exits after the current check
+			if threading.current_thread() is not self._thread:
+				self._thread.join()
+			self._thread = None
+
+	def enter(self, server, func, event):
+		"""Called by the server before running func"""
+		self._active.setdefault(threading.get_ident(), []).append([server, func, event, time.monotonic(), False])
+
+	def exit(self):
+		"""Called by the server once the function given to the last call to enter returns"""
+		ident = threading.get_ident()
+		stack = self._active.get(ident)
+		if not stack:
+			return
+		entry = stack.pop()
+		if not stack:
+			del self._active[ident]
+		if entry[4]:
+			duration = time.monotonic() - entry[3]
+			if duration > self.metrics["longest"]:
+				self.metrics["longest"] = duration
+
+	def check(self):
+		"""Reports calls and readers that have gone over the threshold. Called every interval seconds"""
+		now = time.monotonic()
+		self._frames = None
+		for ident, stack in list(self._active.items()):
+			for entry in list(stack):
+				server, func, event, started, reported = entry
+				if reported or now - started < self.threshold:
+					continue
+				entry[4] = True
+				self.metrics["stalls"] += 1
+				self._report(server, "call", getattr(func, "__qualname__", repr(func)), event, now - started, ident)
+		for server in list(self.servers):
+			self._check_reader(server, now)
+		self._frames = None
+
+	def _check_reader(self, server, now):
+		ident = server._reader
+		heartbeat = server._heartbeat
+		if now - heartbeat < self.threshold or self._stale.get(server) == heartbeat:
+			return
+		if ident is None:
+			if server.disconnecting or server.logged_out or not server.me:
+				return
+			kind = "no reader"
+		elif server._reading or self._active.get(ident):
+			# waiting for data is fine, and a stuck call has a report of its own
+			return
+		else:
+			kind = "reader"
+		self._stale[server] = heartbeat
+		self.metrics["stalls"] += 1
+		self._report(server, kind, "handle_messages", "", now - heartbeat, ident)
+
+	def _report(self, server, kind, handler, event, duration, ident):
+		if ident is None:
+			thread = stack = ""
+		else:
+			if self._frames is None:
+				self._frames = sys._current_frames()
+				self._threads = {thread.ident: thread.name for thread in threading.enumerate()}
+			frame = self._frames.get(ident)
+			thread = self._threads.get(ident, str(ident))
+			stack = "".join(traceback.format_stack(frame)) if frame else ""
+		self.report({
+			"server": server,
+			"kind": kind,
+			"handler": handler,
+			"event": event,
+			"duration": duration,
+			"thread": thread,
+			"stack": stack,
+		})
+
+	def _run(self, stop):
+		while not stop.wait(self.interval):
+			try:
+				self.check()
+			except Exception:
+				traceback.print_exc()